@@ -4,10 +4,11 @@ from flask import Blueprint, jsonify, url_for
 
 #from nbs.api.user import UserApi
 from nbs.api.supplier import SupplierApi
-from nbs.api.hr import EmployeeApi
+from nbs.api.hr import EmployeeApi, AttendanceApi
 from nbs.api.bank_account import BankApi
 from nbs.api.purchase_order import PurchaseOrderApi
 from nbs.api.product import ProductApi
+from nbs.api.stock import StockApi
 
 api = Blueprint('api', __name__, url_prefix='/api')
 
@@ -29,6 +30,8 @@ def configure_api(app):
     #UserApi.register(app)
     SupplierApi.register(app)
     EmployeeApi.register(app)
+    AttendanceApi.register(app)
     BankApi.register(app)
     PurchaseOrderApi.register(app)
     ProductApi.register(app)
+    StockApi.register(app)
@@ -2,21 +2,37 @@
 
 from flask import jsonify, url_for, abort
 from sqlalchemy.exc import IntegrityError
-from webargs import ValidationError
 from nbs.models import db, Bank, BankAccount
 from nbs.schema import BankAccountSchema, BankSchema
-from nbs.utils.api import ResourceApi, route, build_result
+from nbs.utils.api import ResourceApi, route, build_result, build_many
 from nbs.utils.args import fields, get_args, build_args
+from nbs.utils.loading import LoadingProfile
+from nbs.utils.unique import commit_unique
 
 ba_schema = BankAccountSchema()
+ba_profile = LoadingProfile(BankAccount, ba_schema)
 post_ba_schema = BankAccountSchema(exclude=('bank','supplier_name'))
 bank_schema = BankSchema()
+writable_bank_schema = BankSchema(exclude=('id',))
 
 class BankAccountApi(ResourceApi):
     route_base = 'bank_accounts'
+    batch_model = BankAccount
+    batch_schema = post_ba_schema
 
     post_args = build_args(post_ba_schema, allow_missing=True)
 
+    @classmethod
+    def batch_query(cls, obj=None):
+        q = BankAccount.query
+        if obj:
+            q = q.filter(BankAccount.supplier==obj)
+        return q
+
+    @classmethod
+    def batch_defaults(cls, obj=None):
+        return {'supplier_id': obj.id} if obj else {}
+
     def index(self):
         """
         Returns a paginated list of bank accounts registered in the system
@@ -24,11 +40,11 @@ class BankAccountApi(ResourceApi):
         q = BankAccount.query
         if self.obj:
             q = q.filter(BankAccount.supplier==self.obj)
-        return build_result(q, ba_schema)
+        return build_result(q, ba_schema, profile=ba_profile)
 
     @route('<int:id>')
     def get(self, id):
-        account = BankAccount.query.get_or_404(id)
+        account = ba_profile.get_or_404(id)
         if self.obj:
             if not account.supplier == self.obj:
                 abort(404)
@@ -56,35 +72,36 @@ class BankAccountApi(ResourceApi):
         return '', 204
 
 
-def unique_bank_name(val):
-    exists = Bank.query.filter(Bank.name==val).first()
-    if exists is not None:
-        raise ValidationError('Bank name must be unique', status_code=409)
-
 class BankApi(ResourceApi):
     route_base = 'banks'
+    batch_model = Bank
+    batch_schema = writable_bank_schema
 
     bank_post = {
-        'name': fields.String(required=True, validate=unique_bank_name),
+        'name': fields.String(required=True),
     }
 
     def index(self):
         q = Bank.query.order_by(Bank.name)
         return build_result(q, bank_schema)
 
+    @route('/<rangelist:ids>')
+    def get_many(self, ids):
+        return build_many(Bank.query, ids, bank_schema)
+
     @route('<int:id>', methods=['PUT'])
     def put(self, id):
         b = Bank.query.get_or_404(id)
         args = get_args(self.bank_post)
         b.name = args['name']
-        db.session.commit()
+        commit_unique(Bank)
         return '', 204
 
     def post(self):
         args = get_args(self.bank_post)
         b = Bank(name=args['name'])
         db.session.add(b)
-        db.session.commit()
+        commit_unique(Bank)
         # Only return id of created Bank, we don't have individual retrieves
         return jsonify({'id': b.id}), 201
 
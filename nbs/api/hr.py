@@ -1,70 +1,83 @@
 # -*- coding: utf-8 -*-
 
-from flask import jsonify, request, url_for
-from webargs import ValidationError
+import codecs
+from datetime import date, datetime
+
+from flask import jsonify, request, url_for, current_app
+from webargs.flaskparser import abort
 from nbs.models import db, Employee, AttendanceRecord
-from nbs.schema import EmployeeSchema, AttendanceRecordSchema
-from nbs.utils.api import ResourceApi, NestedApi, route, build_result
+from nbs.models.hr import month_range
+from nbs.schema import (
+    EmployeeSchema, AttendanceRecordSchema, PunchSchema,
+    EmployeeAttendanceSchema, AttendanceTotalsSchema
+)
+from nbs.utils.api import (
+    ResourceApi, NestedApi, route, build_result, build_many
+)
 from nbs.utils.args import get_args, build_args, fields
-from nbs.utils.attendance import fixed_records
+from nbs.utils.attendance import batch_fixed_records
+from nbs.utils.loading import LoadingProfile
+from nbs.utils.analytics import attendance_totals
+from nbs.utils.export import export_result
+from nbs.utils.bulk import PUNCH_FORMATS, read_punches, import_punches
+from nbs.utils.unique import commit_unique
 
 employee_s = EmployeeSchema()
+employee_profile = LoadingProfile(Employee, employee_s)
 writable_schema = EmployeeSchema(
     exclude=('id', 'modified', 'created')
 )
 
 ar_schema = AttendanceRecordSchema()
-
-def unique_file_no(val):
-    exists = Employee.query.filter(Employee.file_no==val).first()
-    if exists is not None:
-        raise ValidationError('Employee file_no must be unique',
-                              status_code=409)
-
-def unique_user_code(val):
-    exists = Employee.query.filter(Employee.user_code==val).first()
-    if exists is not None:
-        raise ValidationError('Employee user_code must be unique',
-                              status_code=409)
+punch_schema = PunchSchema()
+ea_schema = EmployeeAttendanceSchema()
+at_schema = AttendanceTotalsSchema()
 
 post_args = build_args(writable_schema, allow_missing=True)
-post_args['file_no'] = fields.Integer(required=True, validate=unique_file_no)
-post_args['user_code'] = fields.Integer(required=True, validate=unique_user_code)
+post_args['file_no'] = fields.Integer(required=True)
+post_args['user_code'] = fields.Integer(required=True)
 
 patch_args = build_args(writable_schema, allow_missing=True)
-patch_args['file_no'] = fields.Integer(validate=unique_file_no, allow_missing=True)
-patch_args['user_code'] = fields.Integer(validate=unique_user_code,
-                                         allow_missing=True)
+patch_args['file_no'] = fields.Integer(allow_missing=True)
+patch_args['user_code'] = fields.Integer(allow_missing=True)
 
 class EmployeeApi(ResourceApi):
     route_base = 'employees'
+    batch_model = Employee
+    batch_schema = writable_schema
 
     @classmethod
     def get_obj(cls, id):
         return Employee.query.get_or_404(id)
 
     def index(self):
-        return build_result(Employee.query, employee_s)
+        return build_result(Employee.query, employee_s,
+                            profile=employee_profile)
 
     @route('<int:id>')
     def get(self, id):
-        employee = self.get_obj(id)
+        employee = employee_profile.get_or_404(id)
         return build_result(employee, employee_s)
 
+    @route('/<rangelist:ids>')
+    def get_many(self, ids):
+        return build_many(Employee.query, ids, employee_s,
+                          profile=employee_profile)
+
     @route('<int:id>', methods=['PATCH'])
     def patch(self, id):
         employee = self.get_obj(id)
         args = get_args(patch_args)
         for k, v in args.items():
             setattr(employee, k, v)
-        db.session.commit()
+        commit_unique(Employee)
         return '', 204
 
     def post(self):
         args = get_args(post_args)
         employee, e = writable_schema.load(args)
         db.session.add(employee)
-        db.session.commit()
+        commit_unique(Employee)
         return '', 201, {'Location': url_for('.get', id=employee.id,
                                              _external=True)}
 
@@ -78,5 +91,89 @@ class EmployeeApi(ResourceApi):
     @route('<int:id>/records/<int:year>/<int:month>')
     def get_records(self, id, year, month):
         employee = self.get_obj(id)
-        records = employee.month_records(year, month)
-        return build_result(fixed_records(records, year, month), ar_schema)
+        records = employee.fixed_month(year, month)
+        return build_result(records, ar_schema)
+
+    @route('records/export')
+    def export_records(self):
+        """
+        Streams raw attendance records as NDJSON or CSV, optionally for one
+        `user_code` and only records after a given datetime.
+        """
+        q = AttendanceRecord.query
+        user_code = request.args.get('user_code', type=int)
+        if user_code is not None:
+            q = q.filter(AttendanceRecord.user_code==user_code)
+        return export_result(q, punch_schema, 'attendance',
+                             modified=AttendanceRecord.datetime)
+
+
+class AttendanceApi(ResourceApi):
+    route_base = 'attendance'
+
+    @classmethod
+    def get_employees(cls):
+        return Employee.query.filter(Employee.user_code!=None)\
+                             .order_by(Employee.user_code).all()
+
+    @route('punches', methods=['POST'])
+    def punches(self):
+        """
+        Stores the punches of a time clock log (default), CSV or NDJSON
+        body, skipping the ones already stored.
+        """
+        fmt = request.args.get('format')
+        if fmt is None:
+            fmt = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson'}\
+                    .get(request.mimetype, 'dat')
+        if fmt not in PUNCH_FORMATS:
+            abort(400, message='Invalid punches format')
+        lines = codecs.getreader('utf-8')(request.stream)
+        report = import_punches(read_punches(lines, fmt),
+            batch_size=current_app.config.get('PUNCH_BATCH_SIZE', 5000))
+        return jsonify(report)
+
+    @route('<int:year>/<int:month>')
+    def month(self, year, month):
+        """
+        Returns the fixed records of the given month for all employees with
+        an user_code.
+        """
+        employees = self.get_employees()
+        fixed = batch_fixed_records(
+            AttendanceRecord.month_punches(year, month),
+            [(e.user_code, e.worktime_spec) for e in employees], year, month,
+        )
+        result = ({
+            'employee_id': e.id,
+            'user_code': user_code,
+            'first_name': e.first_name,
+            'last_name': e.last_name,
+            'records': records,
+        } for e, (user_code, records) in zip(employees, fixed))
+        return build_result(result, ea_schema)
+
+    @route('<int:year>/summary')
+    @route('<int:year>/<int:month>/summary')
+    def summary(self, year, month=None):
+        """
+        Returns lateness, early exits and overtime (in seconds), worked days
+        and absences of all employees for the given year or month.
+        """
+        if month is None:
+            start, end = date(year, 1, 1), date(year+1, 1, 1)
+        else:
+            start, end = [d.date() for d in month_range(year, month)]
+        employees = self.get_employees()
+        records = AttendanceRecord.range_punches(
+            datetime.combine(start, datetime.min.time()),
+            datetime.combine(end, datetime.min.time()),
+        )
+        totals = attendance_totals(
+            records, [(e.user_code, e.worktime_spec) for e in employees],
+            start, end, until=date.today(),
+        )
+        result = [dict(t._asdict(), employee_id=e.id, user_code=e.user_code,
+                       first_name=e.first_name, last_name=e.last_name)
+                  for e, t in zip(employees, totals)]
+        return build_result(result, at_schema)
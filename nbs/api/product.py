@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
-from flask import jsonify, request, url_for
+import codecs
+
+from flask import jsonify, request, url_for, Response
+from webargs.flaskparser import abort
 from nbs.models import db, Product
-from nbs.schema import ProductSchema
-from nbs.utils.api import ResourceApi, build_result, route
+from nbs.schema import ProductSchema, ProductImportSchema
+from nbs.utils.api import ResourceApi, build_result, build_many, route
+from nbs.utils.export import export_result
+from nbs.utils.bulk import BULK_FORMATS, read_records, bulk_import
+from nbs.utils.lookup import product_lookup
 
 p_schema = ProductSchema()
+import_schema = ProductImportSchema()
 
 
 class ProductApi(ResourceApi):
@@ -16,9 +23,61 @@ class ProductApi(ResourceApi):
         return Product.query.get_or_404(id)
 
     def index(self):
-        return build_result(Product.query, p_schema)
+        return build_result(Product.query, p_schema, key=Product.sku,
+                            conditional=True)
 
     @route('<int:id>')
     def get(self, id):
         product = self.get_obj(id)
-        return build_result(product, p_schema)
+        return build_result(product, p_schema, conditional=True)
+
+    @route('/<rangelist:ids>')
+    def get_many(self, ids):
+        return build_many(Product.query, ids, p_schema)
+
+    def search(self):
+        """
+        Returns products matching `q` param, exact and prefix matches of sku
+        or barcode first, then the ones with description containing it.
+        """
+        q = request.args.get('q', '').strip()
+        if not q:
+            abort(400, message='Missing q parameter')
+        if len(q) > 64:
+            abort(400, message='Search query too long')
+        return build_result(Product.search(q), p_schema)
+
+    @route('lookup/<code>')
+    def lookup(self, code):
+        """
+        Returns id, sku, barcode, short_description, price and status of the
+        product with the given sku or barcode, from the in process index.
+        """
+        found = product_lookup.get(code)
+        if found is None:
+            abort(404)
+        return Response(found[1], mimetype='application/json')
+
+    def export(self):
+        """
+        Streams the whole catalog as NDJSON or CSV, optionally only products
+        modified since a given datetime.
+        """
+        return export_result(Product.query, p_schema, 'products',
+                             key=Product.sku, modified=Product.modified)
+
+    @route('import', methods=['POST'])
+    def bulk_import(self):
+        """
+        Creates or updates (by sku) products from a CSV or NDJSON body, the
+        format is taken from `format` param or request content type.
+        """
+        fmt = request.args.get('format')
+        if fmt is None:
+            fmt = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        if fmt not in BULK_FORMATS:
+            abort(400, message='Invalid import format')
+        lines = codecs.getreader('utf-8')(request.stream)
+        report = bulk_import(Product, import_schema, 'sku',
+                             read_records(lines, fmt))
+        return jsonify(report)
@@ -3,9 +3,10 @@
 from flask import jsonify, url_for, abort
 from nbs.models import db, PurchaseOrder, PurchaseOrderItem
 from marshmallow import Schema, fields
-from nbs.schema import TimestampSchema
+from nbs.schema import TimestampSchema, DynamicNested
 from nbs.utils.api import ResourceApi, route, build_result
 from nbs.utils.args import get_args, build_args
+from nbs.utils.loading import LoadingProfile
 
 
 class PurchaseOrderSchema(TimestampSchema):
@@ -18,7 +19,7 @@ class PurchaseOrderSchema(TimestampSchema):
     supplier_id = fields.Integer()
     supplier_name = fields.String(attribute='supplier.name')
 
-    items = fields.Nested('PurchaseOrderItemSchema', many=True,
+    items = DynamicNested('PurchaseOrderItemSchema', many=True,
                           exclude=('id', 'order_id'))
 
 
@@ -33,22 +34,36 @@ class PurchaseOrderItemSchema(Schema):
 
 
 po_schema = PurchaseOrderSchema()
+po_profile = LoadingProfile(PurchaseOrder, po_schema)
 post_po_schema = PurchaseOrderSchema(exclude=('issue', 'supplier_name'))
 
 class PurchaseOrderApi(ResourceApi):
     route_base = 'purchases/orders'
+    batch_model = PurchaseOrder
+    batch_schema = post_po_schema
 
     post_args = build_args(post_po_schema, allow_missing=True)
 
+    @classmethod
+    def batch_query(cls, obj=None):
+        q = PurchaseOrder.query
+        if obj:
+            q = q.filter(PurchaseOrder.supplier==obj)
+        return q
+
+    @classmethod
+    def batch_defaults(cls, obj=None):
+        return {'supplier_id': obj.id} if obj else {}
+
     def index(self):
         q = PurchaseOrder.query
         if self.obj:
             q = q.filter(PurchaseOrder.supplier==self.obj)
-        return build_result(q, po_schema)
+        return build_result(q, po_schema, profile=po_profile)
 
     @route('<int:id>')
     def get(self, id):
-        po = PurchaseOrder.query.get_or_404(id)
+        po = po_profile.get_or_404(id)
         if self.obj:
             if not po.supplier == self.obj:
                 abort(404)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from dateutil.parser import parse
+from flask import jsonify, request, current_app
+from sqlalchemy.exc import IntegrityError
+from webargs.flaskparser import abort
+from nbs.models import (
+    db, Product, Warehouse, ProductStock, StockTransaction, StockSnapshot
+)
+from nbs.models.stock import InsufficientStock
+from nbs.schema import ProductStockSchema, StockMovementSchema
+from nbs.utils.api import ResourceApi, route, build_result
+from nbs.utils.bulk import IN_CHUNK_SIZE
+
+stock_schema = ProductStockSchema()
+movement_schema = StockMovementSchema()
+
+
+class StockApi(ResourceApi):
+    route_base = 'stock'
+
+    def index(self):
+        """
+        Returns stock balances, optionally only of a `product_id` or a
+        `warehouse_id`.
+        """
+        q = ProductStock.query
+        for name in ('product_id', 'warehouse_id'):
+            value = request.args.get(name, type=int)
+            if value is not None:
+                q = q.filter(getattr(ProductStock, name)==value)
+        q = q.order_by(ProductStock.product_id, ProductStock.warehouse_id)
+        return build_result(q, stock_schema)
+
+    @route('<int:warehouse_id>/at')
+    def at(self, warehouse_id):
+        """
+        Returns the stock of a warehouse before the `date` param, replaying
+        the transactions after the nearest previous snapshot.
+        """
+        Warehouse.query.get_or_404(warehouse_id)
+        try:
+            date = parse(request.args['date'])
+        except KeyError:
+            abort(400, message='Missing date parameter')
+        except (ValueError, OverflowError):
+            abort(400, message='Invalid date parameter')
+        return build_result(StockSnapshot.balances(warehouse_id, date),
+                            stock_schema)
+
+    @route('movements', methods=['POST'])
+    def movements(self):
+        """
+        Applies all the lines of a stock movement (a goods receipt, a sale)
+        in one transaction, or none of them when any product hasn't enough
+        stock. Returns the resulting balances.
+        """
+        data, errors = movement_schema.load(
+            request.get_json(force=True, silent=True) or {}
+        )
+        if errors:
+            abort(400, message='Invalid stock movement', messages=errors)
+        lines = data['lines']
+        max_lines = current_app.config.get('MAX_ITEMS_PER_BATCH', 1000)
+        if not lines or len(lines) > max_lines:
+            abort(400, message='A movement needs 1 to {} lines'.format(
+                max_lines))
+        Warehouse.query.get_or_404(data['warehouse_id'])
+
+        ids = list(set(line['product_id'] for line in lines))
+        found = set()
+        for i in range(0, len(ids), IN_CHUNK_SIZE):
+            q = db.session.query(Product.id)\
+                    .filter(Product.id.in_(ids[i:i+IN_CHUNK_SIZE]))
+            found.update(id for id, in q)
+        missing = sorted(set(ids) - found)
+        if missing:
+            abort(400, message='Unknown products',
+                  messages={'product_id': missing})
+
+        sign = -1 if data['type'] in StockTransaction.decrease_types else 1
+        try:
+            balances = ProductStock.move_many([{
+                'product_id': line['product_id'],
+                'warehouse_id': data['warehouse_id'],
+                'quantity': sign * line['quantity'],
+                'unit_cost': line.get('unit_cost'),
+                'type': data['type'],
+            } for line in lines])
+            db.session.commit()
+        except InsufficientStock as e:
+            db.session.rollback()
+            abort(409, message=str(e), messages={'lines': [{
+                'product_id': product_id,
+                'available': str(available),
+                'requested': str(-delta),
+            } for product_id, _, available, delta in e.shortages]})
+        except IntegrityError:
+            # a balance was created by a concurrent movement
+            db.session.rollback()
+            abort(409, message='Stock changed meanwhile, try again')
+
+        stock = [{'product_id': p, 'warehouse_id': w, 'quantity': q}
+                 for (p, w), q in sorted(balances.items())]
+        return jsonify({
+            'lines': len(lines),
+            'stock': stock_schema.dump(stock, many=True).data,
+        }), 201
@@ -1,25 +1,22 @@
 # -*- coding: utf-8 -*-
 
 from flask import jsonify, request, url_for
-from webargs import ValidationError
 from nbs.models import db, Supplier
-from nbs.schema import EntitySchema, BankAccountSchema
-from nbs.utils.api import ResourceApi, NestedApi, route, build_result
+from nbs.schema import EntitySchema, BankAccountSchema, DynamicNested
+from nbs.utils.api import (
+    ResourceApi, NestedApi, route, build_result, build_many
+)
 from nbs.utils.args import get_args, build_args, fields
+from nbs.utils.loading import LoadingProfile
+from nbs.utils.export import export_result
+from nbs.utils.unique import ensure_unique, commit_unique
 
 from nbs.api.bank_account import BankAccountApi
 from nbs.api.purchase_order import PurchaseOrderApi
 
 
-def unique_supplier_name(val):
-    exists = Supplier.query.filter(Supplier.name==val).first()
-    if exists is not None:
-        import pudb; pudb.set_trace()
-        raise ValidationError('Supplier name must be unique', status_code=409)
-
-
 class SupplierSchema(EntitySchema):
-    name = fields.String(validate=unique_supplier_name)
+    name = fields.String()
     fiscal_data = fields.Nested('FiscalDataSchema', allow_null=True)
     customer_no = fields.String(default=None)
     payment_term = fields.Integer(default=None)
@@ -34,7 +31,7 @@ class SupplierSchema(EntitySchema):
                                   only=('id', 'bank', 'type'))
     purchases = fields.Nested('PurchaseDocumentSchema', many=True,
                               only=('id', 'status', 'issue'))
-    orders = fields.Nested('PurchaseOrderSchema', many=True,
+    orders = DynamicNested('PurchaseOrderSchema', many=True,
                            only=('id', 'status', 'issue'))
 
     def make_object(self, data):
@@ -43,6 +40,7 @@ class SupplierSchema(EntitySchema):
         return Supplier(**data)
 
 s_schema = SupplierSchema(strict=True)
+s_profile = LoadingProfile(Supplier, s_schema)
 ba_schema = BankAccountSchema(many=True,
                               exclude=('supplier_id', 'supplier_name'))
 
@@ -53,14 +51,15 @@ writable_schema = SupplierSchema(
 writable_schema.fields['name'].required = True
 
 #post_args = build_args(writable_schema, allow_missing=True)
-#post_args['name'] = fields.String(required=True, validate=unique_supplier_name)
+#post_args['name'] = fields.String(required=True)
 
 #patch_args = build_args(writable_schema, allow_missing=True)
-#patch_args['name'] = fields.String(validate=unique_supplier_name,
-#                                   allow_missing=True)
+#patch_args['name'] = fields.String(allow_missing=True)
 
 class SupplierApi(ResourceApi):
     route_base = 'suppliers'
+    batch_model = Supplier
+    batch_schema = writable_schema
 
     @classmethod
     def get_obj(cls, id):
@@ -71,28 +70,33 @@ class SupplierApi(ResourceApi):
         Returns a paginated list of suppliers that match with the given
         conditions.
         """
-        return build_result(Supplier.query, s_schema)
+        return build_result(Supplier.query, s_schema, profile=s_profile)
 
     @route('<int:id>')
     def get(self, id):
         """Returns an individual supplier given an id"""
-        supplier = self.get_obj(id)
+        supplier = s_profile.get_or_404(id)
         return build_result(supplier, s_schema)
 
     @route('/<rangelist:ids>')
     def get_many(self, ids):
-        suppliers = []
-        for id in ids:
-            s = Supplier.query.get(id)
-            if s is not None:
-                suppliers.append(s)
-        return build_result(suppliers, s_schema)
+        """Returns suppliers given a list of ids and ranges of ids"""
+        return build_many(Supplier.query, ids, s_schema, profile=s_profile)
+
+    def export(self):
+        """
+        Streams all suppliers as NDJSON or CSV, optionally only suppliers
+        modified since a given datetime.
+        """
+        return export_result(Supplier.query, s_schema, 'suppliers',
+                             modified=Supplier.modified, profile=s_profile)
 
     def post(self):
         args = get_args(writable_schema)
+        ensure_unique(Supplier, args)
         supplier, e = writable_schema.load(args)
         db.session.add(supplier)
-        db.session.commit()
+        commit_unique(Supplier)
         return '', 201, {'Location': url_for('.get', id=supplier.id,
                                              _external=True)}
         return build_result(supplier, s_schema), 201
@@ -101,9 +105,10 @@ class SupplierApi(ResourceApi):
     def patch(self, id):
         supplier = self.get_obj(id)
         args = get_args(s_schema)
+        ensure_unique(Supplier, args, id)
         for k, v in args.items():
             setattr(supplier, k, v)
-        db.session.commit()
+        commit_unique(Supplier)
         return '', 204
 
     @route('<int:id>', methods=['DELETE'])
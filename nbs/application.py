@@ -10,6 +10,8 @@ from webargs.flaskparser import abort
 from nbs.models import configure_db
 #from nbs.auth import configure_auth
 from nbs.api import configure_api
+from nbs.utils.api import COUNT_MODES
+from nbs.utils.lookup import product_lookup
 from nbs.utils.converters import (
     ListConverter, RangeConverter, RangeListConverter
 )
@@ -29,6 +31,7 @@ def create_app(config=None, app_name=None):
     configure_db(app)
     #configure_auth(app)
     configure_api(app)
+    product_lookup.configure(app)
 
     return app
 
@@ -58,6 +61,14 @@ def configure_app(app, config=None):
         request.omit = set(
             ','.join(request.args.getlist('omit')).split(',')
         )
+        request.after = request.args.get('after')
+        request.stream_result = request.args.get('stream', '').lower() in \
+                ('1', 'true', 'yes')
+        request.count = request.args.get(
+            'count', app.config.get('DEFAULT_COUNT_MODE', 'exact')
+        )
+        if request.count not in COUNT_MODES:
+            abort(400, message='Invalid count mode')
         try:
             request.page = int(request.args.get('page', 1))
             request.per_page = min(int(request.args.get('per_page', 25)),
@@ -29,6 +29,71 @@ def initdb(create_admin_user=True, with_fixtures=False):
     #    from nbs.sample_data import install_fixtures
     #    install_fixtures()
 
+@manager.command
+def index_products():
+    """Creates product search indexes (pg_trgm or FTS5) missing"""
+    from nbs.models.product import create_search_indexes
+    create_search_indexes(db.engine)
+
+@manager.command
+def import_products(path, format=None):
+    """Creates or updates products from a CSV or NDJSON file"""
+    import io
+    from nbs.models import Product
+    from nbs.schema import ProductImportSchema
+    from nbs.utils.bulk import read_records, bulk_import
+    if format is None:
+        format = 'csv' if path.endswith('.csv') else 'ndjson'
+    with io.open(path, encoding='utf-8', newline='') as lines:
+        report = bulk_import(Product, ProductImportSchema(), 'sku',
+                             read_records(lines, format))
+    print("{rows} rows read, {imported} imported".format(**report))
+    for error in report['errors']:
+        print("row {row}: {messages}".format(**error))
+
+@manager.command
+def import_punches(path, format=None):
+    """Stores time clock punches from a log, CSV or NDJSON file"""
+    import io
+    from nbs.utils import bulk
+    if format is None:
+        format = {'.csv': 'csv', '.ndjson': 'ndjson', '.json': 'ndjson'}\
+                .get(path[path.rfind('.'):], 'dat')
+    with io.open(path, encoding='utf-8', newline='') as lines:
+        report = bulk.import_punches(bulk.read_punches(lines, format))
+    print("{rows} rows read, {inserted} inserted, {skipped} skipped"
+          .format(**report))
+    for error in report['errors']:
+        print("row {row}: {messages}".format(**error))
+
+@manager.command
+def summarize_attendance(year, month):
+    """Materializes the fixed attendance records of a closed month"""
+    from nbs.models import Employee
+    year, month = int(year), int(month)
+    employees = Employee.query.filter(Employee.user_code!=None)\
+                              .order_by(Employee.user_code)
+    for employee in employees:
+        employee.fixed_month(year, month, store=True)
+        db.session.commit()
+    print("{}-{:02d} summarized".format(year, month))
+
+@manager.command
+def snapshot_stock(date=None):
+    """Takes stock snapshots of all warehouses, before today by default"""
+    from datetime import datetime, time
+    from dateutil.parser import parse
+    from nbs.models import Warehouse, StockSnapshot
+    if date is None:
+        date = datetime.combine(datetime.today(), time.min)
+    else:
+        date = parse(date)
+    for warehouse in Warehouse.query.order_by(Warehouse.id):
+        snapshot = StockSnapshot.take(warehouse.id, date)
+        db.session.commit()
+        print("{}: snapshot {} at {}, {} items".format(
+            warehouse.name, snapshot.id, date, snapshot.items.count()))
+
 @manager.command
 def dropdb():
     """Drops all database tables"""
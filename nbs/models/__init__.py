@@ -10,7 +10,7 @@ def configure_db(app):
 
 from nbs.models.supplier import Supplier
 from nbs.models.contact import Contact, SupplierContact
-from nbs.models.hr import Employee, AttendanceRecord
+from nbs.models.hr import Employee, AttendanceRecord, AttendanceSummary
 from nbs.models.fiscal import FiscalData
 from nbs.models.bank import Bank, BankAccount
 from nbs.models.document import (
@@ -19,3 +19,6 @@ from nbs.models.document import (
 from nbs.models.misc import Address, Email, Phone, ExtraField
 
 from nbs.models.product import Product
+from nbs.models.stock import (
+    Warehouse, ProductStock, StockTransaction, StockSnapshot, StockSnapshotItem
+)
@@ -1,14 +1,32 @@
 # -*- coding: utf-8 -*-
 
-from datetime import date
+import json
+from collections import defaultdict
+from itertools import chain
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from sqlalchemy.orm import Session
 
 from nbs.models import db
 from nbs.models.entity import Entity
+from nbs.utils.attendance import (
+    compile_worktime, perfect_grid, fixed_records, spec_key, Record,
+    encode_intervals, decode_intervals
+)
+
+
+def month_range(year, month):
+    "Return the [start, end) datetime range of the given month"
+    start = datetime(year, month, 1)
+    return start, start + relativedelta(months=1)
 
 
 class AttendanceRecord(db.Model):
     __tablename__ = 'attendance_record'
+    __table_args__ = (
+        db.Index('ix_attendance_record_user_code_datetime',
+                 'user_code', 'datetime'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_code = db.Column(db.Integer, nullable=False)
@@ -16,6 +34,22 @@ class AttendanceRecord(db.Model):
     bkp_type = db.Column(db.Integer, nullable=False)
     type_code = db.Column(db.Integer, nullable=False)
 
+    @classmethod
+    def range_punches(cls, start, end):
+        """
+        Return a query for (user_code, datetime) of all records in the
+        [start, end) range, ordered by user_code and datetime.
+        """
+        return db.session.query(cls.user_code, cls.datetime)\
+                .filter(cls.datetime>=start)\
+                .filter(cls.datetime<end)\
+                .order_by(cls.user_code, cls.datetime)
+
+    @classmethod
+    def month_punches(cls, year, month):
+        "Like `range_punches` for all records in the given month"
+        return cls.range_punches(*month_range(year, month))
+
     def __repr__(self):
         return "<Record({}, {} {})>".format(self.user_code,
             self.datetime.isoformat(' '), "OUT" if self.type_code else "IN")
@@ -37,6 +71,9 @@ class Employee(Entity):
     user_code = db.Column(db.Integer, unique=True)
     file_no = db.Column(db.Integer, unique=True)
 
+    #: json encoded worktime spec, `None` to use the default one
+    _worktime = db.Column('worktime', db.UnicodeText)
+
     records = db.relationship(
         AttendanceRecord,
         primaryjoin=user_code == db.foreign(AttendanceRecord.user_code),
@@ -53,10 +90,171 @@ class Employee(Entity):
         today = date.today()
         return relativedelta(today, self.hire_date)
 
+    @property
+    def worktime(self):
+        if self._worktime is None:
+            return None
+        return json.loads(self._worktime)
+
+    @worktime.setter
+    def worktime(self, value):
+        """Set worktime spec, raises ValueError if it isn't valid"""
+        if value is None:
+            self._worktime = None
+        else:
+            compile_worktime(value)
+            self._worktime = json.dumps(value, sort_keys=True)
+
+    @property
+    def worktime_spec(self):
+        "Compiled worktime spec of this employee, see `compile_worktime`"
+        return compile_worktime(self.worktime)
+
     def month_records(self, year, month):
+        """
+        Return a query for the records of the given month ordered by datetime,
+        it's resolved with a range scan on (user_code, datetime) index.
+        """
+        start, end = month_range(year, month)
         return self.records\
-                .filter(db.extract('year', AttendanceRecord.datetime)==year)\
-                .filter(db.extract('month', AttendanceRecord.datetime)==month)
+                .filter(AttendanceRecord.datetime>=start)\
+                .filter(AttendanceRecord.datetime<end)\
+                .order_by(AttendanceRecord.datetime)
+
+    def month_times(self, year, month):
+        """
+        Like `month_records` but only loads `datetime` column, so the query is
+        answered from the (user_code, datetime) index alone.
+        """
+        start, end = month_range(year, month)
+        return db.session.query(AttendanceRecord.datetime)\
+                .filter(AttendanceRecord.user_code==self.user_code)\
+                .filter(AttendanceRecord.datetime>=start)\
+                .filter(AttendanceRecord.datetime<end)\
+                .order_by(AttendanceRecord.datetime)
+
+    def fixed_month(self, year, month, store=False):
+        """
+        Return fixed records of the given month.
+
+        Closed months are read from `AttendanceSummary` when all their days
+        are there, otherwise they are computed from raw records and, when
+        `store` is true, materialized, changes must be committed by the
+        caller. Current and future months are always computed.
+        """
+        spec = self.worktime_spec
+        grid = perfect_grid(year, month, spec)
+        start, end = month_range(year, month)
+        if end.date() > date.today() or self.user_code is None:
+            return list(fixed_records(self.month_times(year, month), year,
+                                      month, grid))
+
+        rows = AttendanceSummary.query\
+                .filter(AttendanceSummary.user_code==self.user_code)\
+                .filter(AttendanceSummary.day>=start.date())\
+                .filter(AttendanceSummary.day<end.date())\
+                .filter(AttendanceSummary.spec_key==spec_key(spec))\
+                .order_by(AttendanceSummary.day).all()
+        if len(rows) == len(grid):
+            return [row.record for row in rows]
+
+        records = list(fixed_records(self.month_times(year, month), year,
+                                     month, grid))
+        if store:
+            AttendanceSummary.store(self.user_code, spec, records)
+        return records
 
     def __repr__(self):
         return "<Employee '{}', age {}>".format(self.name, self.age.years)
+
+
+class AttendanceSummary(db.Model):
+    """
+    Materialized fixed record of an employee day, updated by
+    `AttendanceSummary.refresh` when the records of the day change.
+    """
+    __tablename__ = 'attendance_summary'
+
+    user_code = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True)
+
+    #: `spec_key` of the worktime spec used to fix the day
+    spec_key = db.Column(db.Unicode(40), nullable=False)
+
+    #: json encoded intervals, see `encode_intervals`
+    intervals = db.Column(db.UnicodeText, nullable=False)
+
+    @property
+    def record(self):
+        return Record(self.day, decode_intervals(self.intervals))
+
+    @classmethod
+    def store(cls, user_code, spec, records):
+        "Replace the summaries of user_code for the days of records"
+        records = list(records)
+        if not records:
+            return
+        cls.query.filter(cls.user_code==user_code)\
+                 .filter(cls.day.in_([r.day for r in records]))\
+                 .delete(synchronize_session=False)
+        key = spec_key(spec)
+        db.session.bulk_insert_mappings(cls, [{
+            'user_code': user_code,
+            'day': r.day,
+            'spec_key': key,
+            'intervals': encode_intervals(r.intervals),
+        } for r in records])
+
+    @classmethod
+    def refresh(cls, pairs):
+        """
+        Recompute the summaries of the given (user_code, day) pairs, with one
+        records query per employee.
+        """
+        days = defaultdict(set)
+        for user_code, day in pairs:
+            days[user_code].add(day)
+
+        employees = Employee.query\
+                .filter(Employee.user_code.in_(list(days.keys())))
+        for employee in employees:
+            user_days = days[employee.user_code]
+            spec = employee.worktime_spec
+            punches = db.session.query(AttendanceRecord.datetime)\
+                .filter(AttendanceRecord.user_code==employee.user_code)\
+                .filter(AttendanceRecord.datetime>=min(user_days))\
+                .filter(AttendanceRecord.datetime<
+                        max(user_days) + timedelta(days=1))\
+                .order_by(AttendanceRecord.datetime).all()
+
+            records = []
+            for year, month in set((d.year, d.month) for d in user_days):
+                grid = [g for g in perfect_grid(year, month, spec)
+                        if g[0] in user_days]
+                records.extend(fixed_records(punches, year, month, grid))
+            cls.store(employee.user_code, spec, records)
+
+
+def _mark_attendance_day(mapper, connection, target):
+    session = db.object_session(target)
+    if session is not None:
+        session.info.setdefault('attendance_days', set())\
+                .add((target.user_code, target.datetime.date()))
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    db.event.listen(AttendanceRecord, _event, _mark_attendance_day)
+
+def _pending_records(session):
+    return any(isinstance(obj, AttendanceRecord)
+               for obj in chain(session.new, session.dirty, session.deleted))
+
+@db.event.listens_for(Session, 'before_commit')
+def _refresh_attendance_summaries(session):
+    if _pending_records(session):
+        # the flush of the commit runs after this hook, do it first so the
+        # days of pending records are marked
+        session.flush()
+    pairs = session.info.pop('attendance_days', None)
+    if not pairs:
+        return
+    AttendanceSummary.refresh(pairs)
@@ -1,9 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import re
 from datetime import datetime
+
+from sqlalchemy import DDL, and_, or_, case, func, literal, select, union_all
+from sqlalchemy import text, Integer, Float
+from sqlalchemy.orm.exc import NoResultFound
+
 from nbs.models import db
 from nbs.models.misc import TimestampMixin
 
+#: queries shorter than this only match codes, as they can't use the
+#: trigram index and would match most of the catalog
+SEARCH_MIN_TEXT = 3
+
+#: max number of description matches ranked by search
+SEARCH_MAX_CANDIDATES = 1000
+
 
 class ProductCategory(db.Model):
     __tablename__ = 'product_category'
@@ -50,6 +63,9 @@ class ProductCategory(db.Model):
 
 class Product(db.Model, TimestampMixin):
     __tablename__ = 'product'
+    __table_args__ = (
+        db.Index('ix_product_modified', 'modified'),
+    )
 
     #: the product is available and can be used on a |purchase|/|sale|
     STATUS_AVAILABLE = 'STATUS_AVAILABLE'
@@ -202,8 +218,7 @@ class Product(db.Model, TimestampMixin):
         if warehouse is None:
             raise ValueError('warehouse cannot be `None`')
 
-        stock = self.get_stock_for_warehouse(warehouse)
-        stock.increase_stock(quantity, warehouse, type, unit_cost)
+        ProductStock.move(self.id, warehouse.id, quantity, type, unit_cost)
 
     def decrease_stock(self, quantity, warehouse, type):
         """
@@ -222,14 +237,8 @@ class Product(db.Model, TimestampMixin):
         if warehouse is None:
             raise ValueError('warehouse cannot be `None`')
 
-        stock = self.get_stock_for_warehouse(warehouse)
-
-        if quantity > stock.quantity:
-            raise ValueError('quantity to decrease is greater than the '
-                             'available stock.')
-
-        stock.decrease_stock(quantity, warehouse, type)
-        return stock
+        ProductStock.move(self.id, warehouse.id, -quantity, type)
+        return self.get_stock_for_warehouse(warehouse, create=False)
 
     def get_stock_for_warehouse(self, warehouse, create=True):
         """
@@ -248,3 +257,142 @@ class Product(db.Model, TimestampMixin):
                                     quantity=0)
             else:
                 return None
+
+    @classmethod
+    def search(cls, q):
+        """
+        Return a query for products matching q, ranked with exact sku or
+        barcode matches first, then the ones with codes starting with q and
+        last the ones with description containing q.
+
+        Codes are matched with ranges over their indexes, descriptions with
+        the trigram index on PostgreSQL and the `product_fts` table on SQLite
+        when they were made (see `create_search_indexes`), with LIKE
+        otherwise.
+        """
+        bind = db.session.get_bind()
+        dialect = bind.dialect.name
+        sku, barcode = cls.sku, cls.barcode
+        if dialect == 'postgresql':
+            # byte order, so the range matches the `COLLATE "C"` indexes
+            sku, barcode = sku.collate('C'), barcode.collate('C')
+        lo, hi = prefix_range(q)
+        prefix = or_(and_(sku>=lo, sku<hi), and_(barcode>=lo, barcode<hi))
+        rank = case([(or_(cls.sku==q, cls.barcode==q), 0)], else_=1)
+        hits = [select([cls.id.label('id'), rank.label('rank'),
+                        literal(0.0).label('score')]).where(prefix)]
+
+        terms = re.findall(r'\w+', q, re.UNICODE)
+        if len(q) >= SEARCH_MIN_TEXT and terms:
+            fts = has_fts(bind)
+            if dialect == 'sqlite' and fts:
+                match = ' '.join('"{}"*'.format(t) for t in terms)
+                matches = text(
+                    "SELECT rowid AS id, 2 AS hit_rank, rank AS score "
+                    "FROM product_fts WHERE product_fts MATCH :match "
+                    "ORDER BY score LIMIT :limit"
+                ).bindparams(match=match, limit=SEARCH_MAX_CANDIDATES)\
+                 .columns(id=Integer, hit_rank=Integer, score=Float)
+            else:
+                pattern = '%{}%'.format(escape_like(q))
+                if dialect == 'postgresql' and fts:
+                    score = -func.similarity(cls.description, q)
+                else:
+                    score = literal(0.0)
+                matches = select([cls.id.label('id'),
+                                  literal(2).label('hit_rank'),
+                                  score.label('score')])\
+                        .where(cls.description.ilike(pattern, escape='\\'))\
+                        .order_by(score).limit(SEARCH_MAX_CANDIDATES)
+            matches = matches.alias('matches')
+            hits.append(select([matches.c.id, matches.c.hit_rank,
+                                matches.c.score]))
+
+        hits = union_all(*hits).alias('hits')
+        best = select([hits.c.id, func.min(hits.c.rank).label('rank'),
+                       func.min(hits.c.score).label('score')])\
+                .group_by(hits.c.id).alias('best')
+        return cls.query.join(best, best.c.id==cls.id)\
+                        .order_by(best.c.rank, best.c.score, cls.sku)
+
+
+def prefix_range(prefix):
+    "Return (lo, hi) so strings starting with prefix are in [lo, hi)"
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def escape_like(value):
+    "Escape LIKE wildcards of value, with backslash as escape char"
+    return value.replace('\\', '\\\\').replace('%', '\\%')\
+                .replace('_', '\\_')
+
+
+_SEARCH_DDL = {
+    'postgresql': [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX IF NOT EXISTS ix_product_description_trgm ON product '
+        'USING gin (description gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS ix_product_sku_c ON product '
+        '(sku COLLATE "C")',
+        'CREATE INDEX IF NOT EXISTS ix_product_barcode_c ON product '
+        '(barcode COLLATE "C")',
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+        "description, short_description, content='product', "
+        "content_rowid='id', prefix='2 3')",
+        "CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON "
+        "product BEGIN INSERT INTO product_fts(rowid, description, "
+        "short_description) VALUES (new.id, new.description, "
+        "new.short_description); END",
+        "CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON "
+        "product BEGIN INSERT INTO product_fts(product_fts, rowid, "
+        "description, short_description) VALUES ('delete', old.id, "
+        "old.description, old.short_description); END",
+        "CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE ON "
+        "product BEGIN INSERT INTO product_fts(product_fts, rowid, "
+        "description, short_description) VALUES ('delete', old.id, "
+        "old.description, old.short_description); INSERT INTO "
+        "product_fts(rowid, description, short_description) VALUES "
+        "(new.id, new.description, new.short_description); END",
+        "INSERT INTO product_fts(product_fts) VALUES ('rebuild')",
+    ],
+}
+
+_FTS_CHECK = {
+    'postgresql': "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'",
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE name = 'product_fts'",
+}
+
+_fts_tables = {}
+
+def has_fts(bind):
+    """
+    Return if the text search support made by `create_search_indexes` is
+    on the database of bind, the `product_fts` table on SQLite and pg_trgm
+    on PostgreSQL.
+    """
+    key = str(bind.engine.url)
+    if key not in _fts_tables:
+        check = _FTS_CHECK.get(bind.dialect.name)
+        _fts_tables[key] = check is not None and \
+                bind.execute(check).scalar() is not None
+    return _fts_tables[key]
+
+def create_search_indexes(bind):
+    """
+    Create the indexes used by `Product.search` on bind, if missing. They
+    need privileges (pg_trgm) or build options (FTS5) plain databases may
+    lack, so they aren't made with the tables, see `index_products`
+    command. Without them search falls back to LIKE.
+    """
+    statements = _SEARCH_DDL.get(bind.dialect.name, [])
+    for statement in statements:
+        bind.execute(DDL(statement))
+    _fts_tables.pop(str(bind.engine.url), None)
+
+db.event.listen(Product.__table__, 'before_drop',
+                DDL('DROP TABLE IF EXISTS product_fts')\
+                    .execute_if(dialect='sqlite'))
+
+
+from nbs.models.stock import ProductStock, StockTransaction
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from collections import OrderedDict
+
+from sqlalchemy import case, and_, or_, func, literal, select, union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.util import identity_key
+
+from nbs.models import db
+
+#: max number of (product, warehouse) keys per statement of `move_many`, so
+#: bind parameters stay under SQLite's limit of 999
+STOCK_CHUNK_SIZE = 200
+
+
+class InsufficientStock(ValueError):
+    """
+    Raised when movements would take stock below zero, `shortages` is a
+    list of (product_id, warehouse_id, available, delta) tuples.
+    """
+
+    def __init__(self, shortages):
+        super(InsufficientStock, self).__init__(
+            'quantity to decrease is greater than the available stock.'
+        )
+        self.shortages = shortages
+
+
+class Warehouse(db.Model):
+    __tablename__ = 'warehouse'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.Unicode, nullable=False, unique=True)
+
+    @classmethod
+    def lock(cls, ids, exclusive=False):
+        """
+        Lock the rows of warehouses with ids until the end of the
+        transaction. Ledger writers take shared locks and snapshots an
+        exclusive one, so no transaction is in flight while a snapshot
+        reads the ledger (see `StockSnapshot.take`).
+        """
+        db.session.query(cls.id).filter(cls.id.in_(sorted(set(ids))))\
+                  .order_by(cls.id).with_for_update(read=not exclusive).all()
+
+    def __repr__(self):
+        return "<Warehouse '{}'>".format(self.name)
+
+
+class StockTransaction(db.Model):
+    """
+    Append only ledger of stock movements, the sum of `quantity` of the
+    transactions of a product in a warehouse is its `ProductStock.quantity`.
+    """
+    __tablename__ = 'stock_transaction'
+    __table_args__ = (
+        db.Index('ix_stock_transaction_product_warehouse',
+                 'product_id', 'warehouse_id'),
+        db.Index('ix_stock_transaction_warehouse_date',
+                 'warehouse_id', 'date'),
+    )
+
+    TYPE_PURCHASE = 'TYPE_PURCHASE'
+    TYPE_SALE = 'TYPE_SALE'
+    TYPE_PURCHASE_RETURN = 'TYPE_PURCHASE_RETURN'
+    TYPE_SALE_RETURN = 'TYPE_SALE_RETURN'
+    TYPE_TRANSFER_IN = 'TYPE_TRANSFER_IN'
+    TYPE_TRANSFER_OUT = 'TYPE_TRANSFER_OUT'
+    TYPE_ADJUSTMENT_IN = 'TYPE_ADJUSTMENT_IN'
+    TYPE_ADJUSTMENT_OUT = 'TYPE_ADJUSTMENT_OUT'
+
+    #: types that take stock out of the warehouse
+    decrease_types = frozenset([
+        TYPE_SALE, TYPE_PURCHASE_RETURN, TYPE_TRANSFER_OUT,
+        TYPE_ADJUSTMENT_OUT,
+    ])
+
+    types = {
+        TYPE_PURCHASE: 'Compra',
+        TYPE_SALE: 'Venta',
+        TYPE_PURCHASE_RETURN: 'Devolucion a proveedor',
+        TYPE_SALE_RETURN: 'Devolucion de cliente',
+        TYPE_TRANSFER_IN: 'Transferencia entrante',
+        TYPE_TRANSFER_OUT: 'Transferencia saliente',
+        TYPE_ADJUSTMENT_IN: 'Ajuste positivo',
+        TYPE_ADJUSTMENT_OUT: 'Ajuste negativo',
+    }
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'),
+                           nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'),
+                             nullable=False)
+
+    #: signed quantity, negative for decreases
+    quantity = db.Column(db.Numeric(10, 3), nullable=False)
+
+    #: unit cost of increases, `None` when unknown
+    unit_cost = db.Column(db.Numeric(10, 2))
+
+    type = db.Column(db.Enum(*types.keys(), name='stock_transaction_type'),
+                     nullable=False)
+    date = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    product = db.relationship('Product')
+    warehouse = db.relationship(Warehouse)
+
+    @property
+    def type_str(self):
+        return self.types[self.type]
+
+    def __repr__(self):
+        return "<StockTransaction {} {} of {} in {}>".format(
+            self.type, self.quantity, self.product_id, self.warehouse_id)
+
+
+class ProductStock(db.Model):
+    """
+    Stock balance of a product in a warehouse, only updated with relative
+    `quantity = quantity + delta` statements, see `ProductStock.move`.
+    """
+    __tablename__ = 'product_stock'
+    __table_args__ = (
+        db.CheckConstraint('quantity >= 0', name='ck_product_stock_quantity'),
+    )
+
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'),
+                           primary_key=True, autoincrement=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'),
+                             primary_key=True, autoincrement=False)
+    quantity = db.Column(db.Numeric(10, 3), nullable=False, default=0)
+
+    product = db.relationship('Product',
+                              backref=db.backref('stock', lazy='dynamic'))
+    warehouse = db.relationship(Warehouse,
+                                backref=db.backref('stock', lazy='dynamic'))
+
+    @classmethod
+    def move(cls, product_id, warehouse_id, delta, type, unit_cost=None):
+        """
+        Add delta (negative to decrease) to the stock of product in warehouse
+        and record the movement in the ledger, raising ValueError when the
+        stock would go negative.
+
+        The balance is changed with a single UPDATE, a decrease only matches
+        when there is enough stock, so concurrent movements never need to
+        read it first. The row is inserted on the first increase.
+        """
+        session = db.session
+        table = cls.__table__
+        Warehouse.lock([warehouse_id])
+        update = table.update()\
+                .where(table.c.product_id==product_id)\
+                .where(table.c.warehouse_id==warehouse_id)\
+                .values(quantity=table.c.quantity + delta)
+        if delta < 0:
+            update = update.where(table.c.quantity >= -delta)
+
+        if session.execute(update).rowcount == 0:
+            if delta < 0:
+                raise ValueError('quantity to decrease is greater than the '
+                                 'available stock.')
+            try:
+                with session.begin_nested():
+                    session.execute(table.insert().values(
+                        product_id=product_id, warehouse_id=warehouse_id,
+                        quantity=delta,
+                    ))
+            except IntegrityError:
+                # inserted meanwhile by a concurrent transaction
+                session.execute(update)
+
+        session.execute(StockTransaction.__table__.insert().values(
+            product_id=product_id, warehouse_id=warehouse_id, quantity=delta,
+            unit_cost=unit_cost, type=type, date=datetime.now(),
+        ))
+
+        loaded = session.identity_map.get(
+            identity_key(cls, (product_id, warehouse_id))
+        )
+        if loaded is not None:
+            session.expire(loaded, ['quantity'])
+
+    @classmethod
+    def move_many(cls, movements):
+        """
+        Apply movements, dicts with `product_id`, `warehouse_id`, signed
+        `quantity`, `type` and optional `unit_cost`, all or none of them.
+        Returns a dict (product_id, warehouse_id) -> new quantity, raises
+        `InsufficientStock` when any balance would go negative.
+
+        Deltas are summed per key and the balances locked in key order, so
+        concurrent batches can't deadlock. Each chunk of `STOCK_CHUNK_SIZE`
+        keys is updated with a single CASE statement, missing balances are
+        inserted and the ledger rows with one executemany.
+        """
+        session = db.session
+        table = cls.__table__
+        deltas = OrderedDict()
+        for m in movements:
+            key = (m['product_id'], m['warehouse_id'])
+            deltas[key] = deltas.get(key, 0) + m['quantity']
+        keys = sorted(deltas)
+        Warehouse.lock(k[1] for k in keys)
+        chunks = [keys[i:i+STOCK_CHUNK_SIZE]
+                  for i in range(0, len(keys), STOCK_CHUNK_SIZE)]
+
+        def in_chunk(chunk):
+            # exact pairs, so rows of other pairs aren't locked or updated
+            return or_(*[and_(table.c.product_id==p,
+                              table.c.warehouse_id==w) for p, w in chunk])
+
+        current = {}
+        for chunk in chunks:
+            q = session.query(table.c.product_id, table.c.warehouse_id,
+                              table.c.quantity)\
+                    .filter(in_chunk(chunk))\
+                    .order_by(table.c.product_id, table.c.warehouse_id)\
+                    .with_for_update()
+            current.update(((p, w), qty) for p, w, qty in q)
+
+        shortages = [(p, w, current.get((p, w), 0), deltas[(p, w)])
+                     for p, w in keys
+                     if current.get((p, w), 0) + deltas[(p, w)] < 0]
+        if shortages:
+            raise InsufficientStock(shortages)
+
+        for chunk in chunks:
+            existing = [k for k in chunk if k in current and deltas[k]]
+            if not existing:
+                continue
+            delta = case([(and_(table.c.product_id==p,
+                                table.c.warehouse_id==w), deltas[(p, w)])
+                          for p, w in existing], else_=0)
+            session.execute(table.update().where(in_chunk(existing))
+                                 .values(quantity=table.c.quantity + delta))
+
+        inserts = [{'product_id': p, 'warehouse_id': w,
+                    'quantity': deltas[(p, w)]}
+                   for p, w in keys if (p, w) not in current]
+        if inserts:
+            session.execute(table.insert(), inserts)
+
+        now = datetime.now()
+        session.execute(StockTransaction.__table__.insert(), [{
+            'product_id': m['product_id'],
+            'warehouse_id': m['warehouse_id'],
+            'quantity': m['quantity'],
+            'unit_cost': m.get('unit_cost'),
+            'type': m['type'],
+            'date': now,
+        } for m in movements])
+
+        for key in keys:
+            loaded = session.identity_map.get(identity_key(cls, key))
+            if loaded is not None:
+                session.expire(loaded, ['quantity'])
+        return dict((k, current.get(k, 0) + deltas[k]) for k in keys)
+
+    def __repr__(self):
+        return "<ProductStock {} of {} in {}>".format(
+            self.quantity, self.product_id, self.warehouse_id)
+
+
+class StockSnapshot(db.Model):
+    """
+    Stock of all products of a warehouse before `date`, so stock at any
+    later time is the snapshot plus the transactions after it, see
+    `StockSnapshot.balances`.
+    """
+    __tablename__ = 'stock_snapshot'
+    __table_args__ = (
+        db.Index('ix_stock_snapshot_warehouse_date', 'warehouse_id', 'date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'),
+                             nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+
+    #: last ledger transaction dated before `date` when taken, a high-water
+    #: mark since no ledger writer of the warehouse is in flight meanwhile,
+    #: transactions dated before `date` but written later have greater ids
+    last_transaction_id = db.Column(db.Integer, nullable=False, default=0)
+
+    created = db.Column(db.DateTime, default=datetime.now)
+
+    warehouse = db.relationship(Warehouse,
+                                backref=db.backref('snapshots',
+                                                   lazy='dynamic'))
+
+    @classmethod
+    def nearest(cls, warehouse_id, date):
+        "Return the last snapshot of warehouse taken up to date, or `None`"
+        return cls.query.filter(cls.warehouse_id==warehouse_id)\
+                        .filter(cls.date<=date)\
+                        .order_by(cls.date.desc()).first()
+
+    @classmethod
+    def deltas(cls, warehouse_id, date, snapshot=None):
+        """
+        Return a select of (product_id, quantity) for the stock of warehouse
+        before date, replaying only the transactions not in snapshot.
+        """
+        tx = StockTransaction.__table__
+        item = StockSnapshotItem.__table__
+        moves = select([tx.c.product_id, tx.c.quantity])\
+                .where(tx.c.warehouse_id==warehouse_id)\
+                .where(tx.c.date<date)
+        if snapshot is None:
+            parts = [moves]
+        else:
+            moves = moves.where(or_(
+                tx.c.date>=snapshot.date,
+                tx.c.id>snapshot.last_transaction_id,
+            ))
+            parts = [moves, select([item.c.product_id, item.c.quantity])
+                            .where(item.c.snapshot_id==snapshot.id)]
+        rows = union_all(*parts).alias('rows')
+        return select([rows.c.product_id,
+                       func.sum(rows.c.quantity).label('quantity')])\
+                .group_by(rows.c.product_id)\
+                .having(func.sum(rows.c.quantity)!=0)
+
+    @classmethod
+    def balances(cls, warehouse_id, date):
+        """
+        Return a query of (product_id, quantity) with the stock of warehouse
+        before date, from the nearest previous snapshot and the transactions
+        after it.
+        """
+        stmt = cls.deltas(warehouse_id, date,
+                          cls.nearest(warehouse_id, date)).alias('balances')
+        return db.session.query(stmt.c.product_id, stmt.c.quantity)\
+                         .order_by(stmt.c.product_id)
+
+    @classmethod
+    def take(cls, warehouse_id, date=None):
+        """
+        Take a snapshot of warehouse before date (now by default), built
+        from the previous snapshot and the transactions after it with a
+        single INSERT ... SELECT. The warehouse stays locked for ledger
+        writers until the caller commits.
+        """
+        if date is None:
+            date = datetime.now()
+        # wait for in flight ledger writers and keep new ones out until
+        # commit, so every transaction with an id up to last_id is visible
+        Warehouse.lock([warehouse_id], exclusive=True)
+        tx = StockTransaction.__table__
+        last_id = db.session.query(func.max(tx.c.id))\
+                .filter(tx.c.warehouse_id==warehouse_id)\
+                .filter(tx.c.date<date).scalar() or 0
+        previous = cls.nearest(warehouse_id, date)
+        snapshot = cls(warehouse_id=warehouse_id, date=date,
+                       last_transaction_id=last_id)
+        db.session.add(snapshot)
+        db.session.flush()
+
+        rows = cls.deltas(warehouse_id, date, previous).alias('rows')
+        item = StockSnapshotItem.__table__
+        db.session.execute(item.insert().from_select(
+            ['snapshot_id', 'product_id', 'quantity'],
+            select([literal(snapshot.id), rows.c.product_id,
+                    rows.c.quantity]),
+        ))
+        return snapshot
+
+    def __repr__(self):
+        return "<StockSnapshot of {} at {}>".format(self.warehouse_id,
+                                                    self.date)
+
+
+class StockSnapshotItem(db.Model):
+    __tablename__ = 'stock_snapshot_item'
+
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('stock_snapshot.id',
+                                                      ondelete='CASCADE'),
+                            primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'),
+                           primary_key=True, autoincrement=False)
+    quantity = db.Column(db.Numeric(10, 3), nullable=False)
+
+    snapshot = db.relationship(StockSnapshot,
+                               backref=db.backref('items', lazy='dynamic'))
@@ -10,6 +10,9 @@ class Supplier(Entity):
     __tablename__ = 'supplier'
     __mapper_args__ = {'polymorphic_identity': u'supplier'}
 
+    #: names live in `entity` shared with other entities, so no constraint
+    __unique_fields__ = ('name',)
+
     FREIGHT_SUPPLIER = 'FREIGHT_SUPPLIER'
     FREIGHT_CUSTOMER = 'FREIGHT_CUSTOMER'
 
@@ -1,8 +1,23 @@
 # -*- coding: utf-8 -*-
 
 from marshmallow import Schema, fields
-from nbs.models import Employee
-from nbs.utils.validators import validate_cuit
+from marshmallow.validate import Length, OneOf
+from nbs.models import Employee, Product, StockTransaction
+from nbs.utils.validators import validate_cuit, validate_worktime
+
+
+class DynamicNested(fields.Nested):
+    """
+    Nested field for lazy='dynamic' relationships, uses the objects prefetched
+    by :class:`nbs.utils.loading.LoadingProfile` when they are available.
+    """
+
+    def get_value(self, attr, obj, *args, **kwargs):
+        prefetched = getattr(obj, '_prefetched', None) or {}
+        key = self.attribute or attr
+        if key in prefetched:
+            return prefetched[key]
+        return super(DynamicNested, self).get_value(attr, obj, *args, **kwargs)
 
 
 class _RefEntitySchema(Schema):
@@ -94,6 +109,38 @@ class ProductSchema(TimestampSchema):
     price = fields.Decimal(places=2, as_string=True)
 
 
+class ProductImportSchema(Schema):
+    sku = fields.String(required=True, validate=Length(1, 24))
+    barcode = fields.String(allow_none=True, validate=Length(max=48))
+    description = fields.String(required=True, validate=Length(1, 128))
+    short_description = fields.String(validate=Length(max=40))
+    notes = fields.String()
+    price = fields.Decimal(places=2, allow_none=True)
+    status = fields.String(validate=OneOf(Product._statuses.keys()))
+    product_type = fields.String(
+        validate=OneOf(Product._product_types.keys())
+    )
+
+
+class ProductStockSchema(Schema):
+    product_id = fields.Integer()
+    warehouse_id = fields.Integer()
+    quantity = fields.Decimal(places=3, as_string=True)
+
+
+class StockLineSchema(Schema):
+    product_id = fields.Integer(required=True)
+    quantity = fields.Decimal(required=True, validate=lambda q: q > 0)
+    unit_cost = fields.Decimal(places=2, allow_none=True)
+
+
+class StockMovementSchema(Schema):
+    type = fields.String(required=True,
+                         validate=OneOf(StockTransaction.types.keys()))
+    warehouse_id = fields.Integer(required=True)
+    lines = fields.Nested(StockLineSchema, many=True, required=True)
+
+
 class BankAccountSchema(Schema):
     id = fields.Integer()
     bank = fields.String(attribute='bank.name')
@@ -120,6 +167,7 @@ class EmployeeSchema(EntitySchema):
     cuil = fields.Method('serialize_cuil', 'deserialize_cuil')
     file_no = fields.Integer()
     user_code = fields.Integer()
+    worktime = fields.Raw(allow_none=True, validate=validate_worktime)
 
     def serialize_cuil(self, obj):
         c = obj.cuil
@@ -132,6 +180,14 @@ class EmployeeSchema(EntitySchema):
         return Employee(**data)
 
 
+class PunchSchema(Schema):
+    id = fields.Integer()
+    user_code = fields.Integer()
+    datetime = fields.DateTime()
+    bkp_type = fields.Integer()
+    type_code = fields.Integer()
+
+
 class IntervalInfoSchema(Schema):
     input = fields.Time()
     output = fields.Time()
@@ -141,3 +197,24 @@ class IntervalInfoSchema(Schema):
 class AttendanceRecordSchema(Schema):
     day = fields.Date()
     intervals = fields.Nested(IntervalInfoSchema, many=True)
+
+
+class EmployeeAttendanceSchema(Schema):
+    employee_id = fields.Integer()
+    user_code = fields.Integer()
+    first_name = fields.String()
+    last_name = fields.String()
+    records = fields.Nested(AttendanceRecordSchema, many=True)
+
+
+class AttendanceTotalsSchema(Schema):
+    employee_id = fields.Integer()
+    user_code = fields.Integer()
+    first_name = fields.String()
+    last_name = fields.String()
+    late = fields.Integer()
+    early_exit = fields.Integer()
+    overtime = fields.Integer()
+    punches = fields.Integer()
+    worked_days = fields.Integer()
+    absences = fields.Integer()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.analytics
+    ~~~~~~~~~~~~~~~~~~~
+
+    Vectorized attendance analytics, lateness, early exits, overtime and
+    absence totals for many employees over long periods.
+"""
+
+from datetime import date
+from collections import namedtuple
+
+import numpy as np
+
+from nbs.utils.attendance import perfect_grid, DUPLICATE_WINDOW
+
+DAY = 24 * 60 * 60
+EPOCH = date(1970, 1, 1)
+
+Slots = namedtuple("Slots", "time day is_input")
+Totals = namedtuple("Totals",
+                    "late early_exit overtime punches worked_days absences")
+
+
+def _months(start, end):
+    "Yield (year, month) for months between start and end dates [start, end)"
+    year, month = start.year, start.month
+    while date(year, month, 1) < end:
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+def build_slots(spec, start, end):
+    """
+    Return Slots with sorted epoch seconds (local time taken as UTC), day
+    number and input/output flag of every expected punch between start and
+    end dates, for the compiled spec.
+    """
+    times, is_input = [], []
+    for year, month in _months(start, end):
+        for day, intervals in perfect_grid(year, month, spec):
+            if not start <= day < end:
+                continue
+            base = (day - EPOCH).days * DAY
+            for interval in intervals:
+                for t, flag in ((interval.input, True),
+                                (interval.output, False)):
+                    times.append(base + (t.hour*60 + t.minute)*60 + t.second)
+                    is_input.append(flag)
+    times = np.array(times, dtype=np.int64)
+    return Slots(times, times // DAY, np.array(is_input, dtype=bool))
+
+
+def punch_arrays(records):
+    """
+    Return (user_codes, times) int64 arrays from records with `user_code` and
+    `datetime`, times as epoch seconds with local time taken as UTC.
+    """
+    records = list(records)
+    codes = np.fromiter((r.user_code for r in records), dtype=np.int64,
+                        count=len(records))
+    times = np.array([r.datetime for r in records], dtype='datetime64[s]')
+    return codes, times.astype(np.int64)
+
+
+_SKIP, _MATCH, _MISS = 0, 1, 2
+
+def match(emp, times, slots, window=DUPLICATE_WINDOW):
+    """
+    Match punches (employee index, epoch time) to slots the same way
+    :func:`nbs.utils.attendance.match_indices` does, with one order keeping
+    assignment per employee and day.
+
+    Punches are laid in a (group, punch) matrix and slots in a (group, slot)
+    one, a group being an employee day, and the dynamic program runs for all
+    groups at once, looping only over slot and punch positions.
+
+    Returns (emp, slot, delta) arrays of the matched punches, delta being the
+    punch time minus the slot time.
+    """
+    n = len(slots.time)
+    empty = np.array([], dtype=np.int64)
+    if n == 0 or len(times) == 0:
+        return empty, empty, empty
+
+    # slots are sorted, so the ones of a day are contiguous
+    days, first, counts = np.unique(slots.day, return_index=True,
+                                    return_counts=True)
+    order = np.lexsort((times, emp))
+    emp, times = emp[order], times[order]
+    day = times // DAY
+    pos = np.searchsorted(days, day)
+    known = pos < len(days)
+    known[known] = days[pos[known]] == day[known]
+    emp, times, day, pos = emp[known], times[known], day[known], pos[known]
+    if len(times) == 0:
+        return empty, empty, empty
+
+    # drop duplicates, punches too close to the previous one of the group
+    new_group = np.ones(len(times), dtype=bool)
+    new_group[1:] = (emp[1:] != emp[:-1]) | (day[1:] != day[:-1])
+    keep = new_group.copy()
+    keep[1:] |= np.diff(times) >= window
+    emp, times, pos, new_group = (emp[keep], times[keep], pos[keep],
+                                  new_group[keep])
+
+    group = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+    col = np.arange(len(times)) - starts[group]
+    g_emp, g_pos = emp[starts], pos[starts]
+    n_groups = len(starts)
+    n_punches = np.bincount(group)
+    n_slots = counts[g_pos]
+    P, M = int(n_punches.max()), int(n_slots.max())
+
+    T = np.zeros((n_groups, P), dtype=np.int64)
+    T[group, col] = times
+    k = np.arange(M)
+    slot_valid = k[None, :] < n_slots[:, None]
+    slot_index = np.where(slot_valid, first[g_pos][:, None] + k[None, :], 0)
+    S = slots.time[slot_index]
+    punch_valid = np.arange(P)[None, :] < n_punches[:, None]
+
+    # costs as missing * big + distance, distances never reach big
+    big = (M + 1) * DAY
+    inf = big * (M + 2)
+    cost = np.zeros((n_groups, P + 1), dtype=np.int64)
+    moves = np.empty((M, n_groups, P + 1), dtype=np.int8)
+    for i in range(M):
+        valid = slot_valid[:, i]
+        miss = np.where(valid, big, 0)
+        dist = np.where(valid[:, None] & punch_valid,
+                        np.abs(T - S[:, i, None]), inf)
+        row = np.empty_like(cost)
+        move = moves[i]
+        row[:, 0] = cost[:, 0] + miss
+        move[:, 0] = _MISS
+        for j in range(1, P + 1):
+            best = row[:, j-1].copy()
+            step = np.full(n_groups, _SKIP, dtype=np.int8)
+            matched = cost[:, j-1] + dist[:, j-1]
+            better = matched < best
+            best[better], step[better] = matched[better], _MATCH
+            missed = cost[:, j] + miss
+            better = missed < best
+            best[better], step[better] = missed[better], _MISS
+            row[:, j], move[:, j] = best, step
+        # padding slots of days with less slots are skipped over
+        row[~valid] = cost[~valid]
+        move[~valid] = _MISS
+        cost = row
+
+    matched_col = np.full((n_groups, M), -1, dtype=np.int64)
+    j = n_punches.copy()
+    rows = np.arange(n_groups)
+    for i in range(M - 1, -1, -1):
+        while True:
+            skip = moves[i, rows, j] == _SKIP
+            if not skip.any():
+                break
+            j[skip] -= 1
+        hit = moves[i, rows, j] == _MATCH
+        matched_col[hit, i] = j[hit] - 1
+        j[hit] -= 1
+
+    g, i = np.nonzero(matched_col >= 0)
+    delta = T[g, matched_col[g, i]] - S[g, i]
+    return g_emp[g], slot_index[g, i], delta
+
+
+def attendance_totals(records, specs, start, end, until=None):
+    """
+    Return a list of Totals, one per (user_code, spec) in specs, for records
+    between start and end dates.
+
+    `records` have `user_code` and `datetime` attributes. Times are in
+    seconds, `absences` counts workdays before `until` (`end` by default)
+    without any matched punch.
+    """
+    until = min(until or end, end)
+
+    user_codes = np.array([user_code for user_code, _ in specs],
+                          dtype=np.int64)
+    order = np.argsort(user_codes, kind='mergesort')
+    sorted_codes = user_codes[order]
+
+    codes, times = punch_arrays(records)
+    pos = np.searchsorted(sorted_codes, codes)
+    known = pos < len(sorted_codes)
+    known[known] = sorted_codes[pos[known]] == codes[known]
+    emp_all = order[pos[known]]
+    times_all = times[known]
+
+    n_emp = len(specs)
+    late = np.zeros(n_emp, dtype=np.int64)
+    early = np.zeros(n_emp, dtype=np.int64)
+    over = np.zeros(n_emp, dtype=np.int64)
+    punches = np.zeros(n_emp, dtype=np.int64)
+    worked = np.zeros(n_emp, dtype=np.int64)
+    absences = np.zeros(n_emp, dtype=np.int64)
+
+    groups = {}
+    for idx, (_, spec) in enumerate(specs):
+        groups.setdefault(spec, []).append(idx)
+
+    limit = (until - EPOCH).days
+    for spec, members in groups.items():
+        slots = build_slots(spec, start, end)
+        members = np.array(members, dtype=np.int64)
+        mask = np.isin(emp_all, members)
+        emp, slot, delta = match(emp_all[mask], times_all[mask], slots)
+
+        def total(values):
+            return np.bincount(emp, values, minlength=n_emp).astype(np.int64)
+
+        is_input = slots.is_input[slot]
+        late += total(np.where(is_input, np.maximum(delta, 0), 0))
+        early += total(np.where(is_input, 0, np.maximum(-delta, 0)))
+        over += total(np.where(is_input, np.maximum(-delta, 0),
+                               np.maximum(delta, 0)))
+        punches += np.bincount(emp, minlength=n_emp)
+
+        if len(slots.day):
+            span = int(slots.day.max()) + 1
+            days = np.unique(emp * span + slots.day[slot])
+            worked += np.bincount(days // span, minlength=n_emp)
+            before = days[days % span < limit]
+            present = np.bincount(before // span, minlength=n_emp)
+            workdays = len(np.unique(slots.day[slots.day < limit]))
+            absences[members] += workdays - present[members]
+
+    return [Totals(*[int(a[i]) for a in (late, early, over, punches, worked,
+                                         absences)])
+            for i in range(n_emp)]
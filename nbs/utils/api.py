@@ -2,33 +2,164 @@
 
 import re
 import inspect
-import copy
+import json
+import time
+import base64
+import hashlib
+import calendar
 from math import ceil
-
-from flask import request, jsonify
+from datetime import datetime
+from collections import OrderedDict
+from itertools import islice
+
+from flask import (
+    request, jsonify, current_app, Response, stream_with_context
+)
+from flask.json import dumps as json_dumps
 from flask.ext.classy import FlaskView, route
+from marshmallow import fields
 from marshmallow.utils import is_collection
+from sqlalchemy import inspect as sa_inspect, func
+from sqlalchemy.orm import (
+    load_only, lazyload, ColumnProperty, RelationshipProperty, SynonymProperty
+)
+from webargs.flaskparser import abort
 
-class Pagination(object):
+from nbs.utils.serializer import get_serializer
+
+#: Accepted values for the `count` request param
+COUNT_MODES = ('exact', 'none', 'estimated', 'cached')
 
-    def __init__(self, iterable, page, per_page):
-        iterable = list(iterable)
-        self.total = len(iterable)
-        offset = (page-1) * per_page
-        limit = min(offset+per_page, self.total)
-        self.items = iterable[offset:limit]
+class Pagination(object):
+    """
+    Pagination over any iterable.
+
+    Sequences are sliced without copying and other iterables are consumed
+    only up to the requested page, so just `per_page` items are held in
+    memory. `total` is computed the first time it is accessed, unless `count`
+    is `none`.
+    """
+
+    def __init__(self, iterable, page, per_page, count='exact'):
+        offset = max(page-1, 0) * per_page
+        if hasattr(iterable, '__len__') and hasattr(iterable, '__getitem__'):
+            self._total = len(iterable)
+            self.items = list(iterable[offset:offset+per_page])
+        else:
+            self._iterator = iter(iterable)
+            skipped = sum(1 for _ in islice(self._iterator, offset))
+            self.items = list(islice(self._iterator, per_page))
+            self._consumed = skipped + len(self.items)
+            if skipped < offset or len(self.items) < per_page:
+                self._total = self._consumed
+            else:
+                self._total = None
+        self.count_type = 'none' if count == 'none' else 'exact'
         self.page = page
         self.per_page = per_page
 
+    @property
+    def total(self):
+        if self.count_type == 'none':
+            return None
+        if self._total is None:
+            self._total = self._consumed + sum(1 for _ in self._iterator)
+        return self._total
+
     @property
     def pages(self):
-        if self.per_page == 0:
+        if self.total is None:
+            pages = None
+        elif self.per_page == 0:
             pages = 0
         else:
             pages = int(ceil(self.total / float(self.per_page)))
         return pages
 
 
+class QueryPagination(Pagination):
+    """
+    Pagination over a query where the total is computed according to `count`,
+    one of `COUNT_MODES`, unless it is already known and given in `total`.
+    """
+
+    total = None
+
+    def __init__(self, query, page, per_page, count='exact', total=None):
+        if page < 1:
+            abort(404)
+        self.items = query.limit(per_page).offset((page-1) * per_page).all()
+        if not self.items and page != 1:
+            abort(404)
+        self.page = page
+        self.per_page = per_page
+        if total is not None and count != 'none':
+            # an exact count already done for query
+            self.total, self.count_type = total, 'exact'
+        else:
+            self.total, self.count_type = count_query(query, count)
+
+
+def count_query(query, mode='exact'):
+    """
+    Return a (total, count_type) tuple for query.
+
+    `none` skips the count, `estimated` reads planner statistics (only on
+    PostgreSQL, an exact count is done otherwise) and `cached` reuses an exact
+    count done for the same statement in the last `COUNT_CACHE_TTL` seconds.
+    """
+    if mode == 'none':
+        return None, 'none'
+    query = query.order_by(None)
+    if mode == 'estimated':
+        estimate = estimate_count(query)
+        if estimate is not None:
+            return estimate, 'estimated'
+    elif mode == 'cached':
+        return cached_count(query), 'cached'
+    return query.count(), 'exact'
+
+def estimate_count(query):
+    "Return the row estimate of the planner for query, `None` if unavailable"
+    conn = query.session.connection()
+    if conn.dialect.name != 'postgresql':
+        return None
+    compiled = query.statement.compile(dialect=conn.dialect)
+    plan = conn.execute('EXPLAIN (FORMAT JSON) ' + str(compiled),
+                        compiled.params).scalar()
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+_count_cache = {}
+
+def cached_count(query):
+    "Return exact count for query, cached by statement and parameters"
+    ttl = current_app.config.get('COUNT_CACHE_TTL', 30)
+    max_size = current_app.config.get('COUNT_CACHE_SIZE', 1024)
+    dialect = query.session.get_bind().dialect
+    compiled = query.statement.compile(dialect=dialect)
+    key = (str(compiled), tuple(sorted(compiled.params.items())))
+    now = time.time()
+
+    cached = _count_cache.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    if len(_count_cache) >= max_size:
+        for k, (total, expires) in list(_count_cache.items()):
+            if expires <= now:
+                del _count_cache[k]
+        if len(_count_cache) >= max_size:
+            del _count_cache[min(_count_cache,
+                                 key=lambda k: _count_cache[k][1])]
+
+    total = query.count()
+    _count_cache[key] = (total, now + ttl)
+    return total
+
+
 def uncamel(name):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
@@ -40,6 +171,10 @@ class ResourceApi(FlaskView):
     name_suffix = 'Api'
     obj = None
 
+    #: model and loading schema of `batch` writes, enabled when both are set
+    batch_model = None
+    batch_schema = None
+
     @classmethod
     def build_route_name(cls, method_name):
         parts = []
@@ -69,6 +204,32 @@ class ResourceApi(FlaskView):
             nested_cls = value.nested_cls
             value.register(name, app, cls)
 
+    @classmethod
+    def batch_query(cls, obj=None):
+        """
+        Return the query of objects that batch operations can update or
+        delete, `obj` being the parent object of nested apis.
+        """
+        return cls.batch_model.query
+
+    @classmethod
+    def batch_defaults(cls, obj=None):
+        "Return data added to every created or updated object of a batch"
+        return {}
+
+    @route('batch', methods=['POST'])
+    def batch(self):
+        """
+        Applies a list of create, update and delete operations in a single
+        transaction, `mode` param tells if it is `atomic` (default) or
+        `partial`, see :func:`nbs.utils.batch.apply_batch`.
+        """
+        if self.batch_model is None or self.batch_schema is None:
+            abort(404)
+        from nbs.utils.batch import apply_batch
+        return apply_batch(self, request.get_json(force=True, silent=True),
+                           request.args.get('mode', 'atomic'))
+
 
 class NestedApi(object):
 
@@ -122,38 +283,377 @@ class NestedApi(object):
         cls.parent = parent
 
 
-def build_result(query, schema):
+def encode_cursor(value):
+    "Return an opaque cursor string for the given key value"
+    raw = json.dumps(value).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    "Return the key value stored in cursor, abort with 400 if it is invalid"
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        return json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        abort(400, message='Invalid cursor')
+
+
+class KeysetPagination(object):
+    """
+    Pages over a query by an indexed unique key instead of OFFSET/LIMIT.
+
+    Only `per_page + 1` rows are fetched (the extra one tells if there is a
+    next page) and no COUNT is issued, so each page costs the same no matter
+    how deep in the collection it is.
+    """
+
+    def __init__(self, query, key, after, per_page):
+        query = query.order_by(None).order_by(key)
+        if after:
+            query = query.filter(key > decode_cursor(after))
+        items = query.limit(per_page + 1).all()
+        self.next = None
+        if len(items) > per_page:
+            items = items[:per_page]
+            self.next = encode_cursor(getattr(items[-1], key.key))
+        self.items = items
+        self.per_page = per_page
+
 
-    if is_collection(query):
-        if hasattr(query, 'paginate') and callable(query.paginate):
-            result = query.paginate(request.page, request.per_page)
+def is_query(obj):
+    "Return if obj is a query, as opposed to a plain collection"
+    return hasattr(obj, 'paginate') and callable(obj.paginate)
+
+def query_entity(query):
+    "Return the mapped class queried by query"
+    return query.column_descriptions[0]['entity']
+
+
+def requested_fields(schema):
+    """
+    Return the set of fields of schema requested with `select` and `omit`
+    params or `None` when all fields are requested.
+    """
+    only = None
+    select = request.select.difference([''])
+    omit = request.omit.difference([''])
+    if select:
+        only = select.intersection(schema.fields.keys())
+    if omit:
+        only = set(only or schema.fields.keys()).difference(omit)
+    if only:
+        only.add('id')
+    return only or None
+
+
+def project_query(query, schema, only, extra=()):
+    """
+    Return query restricted to load just what is needed to serialize `only`
+    fields of schema.
+
+    Eager relationships not needed are loaded lazily and, when every field
+    maps to a column or relationship of the queried model (directly or
+    through a synonym), only those columns (plus `extra` ones) are loaded.
+    """
+    mapper = sa_inspect(query_entity(query))
+    columns = set(extra)
+    relations = set()
+    for name in only:
+        field = schema.fields.get(name)
+        if field is None:
+            continue
+        attr = (field.attribute or name).split('.')[0]
+        prop = mapper.attrs[attr] if attr in mapper.attrs else None
+        while isinstance(prop, SynonymProperty):
+            # ie. Supplier.name for Entity._name_1
+            prop = mapper.attrs[prop.name]
+        if isinstance(field, (fields.Method, fields.Function)):
+            columns = None
+        elif isinstance(prop, RelationshipProperty):
+            relations.add(prop.key)
+        elif isinstance(prop, ColumnProperty):
+            if columns is not None:
+                columns.add(prop.key)
         else:
-            result = Pagination(query, request.page, request.per_page)
+            # properties, we don't know which columns they depend on
+            columns = None
+
+    options = [lazyload(rel.key) for rel in mapper.relationships
+               if rel.key not in relations and
+               rel.lazy in ('joined', 'subquery')]
+    if columns is not None:
+        for key in relations:
+            for col in mapper.relationships[key].local_columns:
+                columns.add(mapper.get_property_by_column(col).key)
+        options.append(load_only(*columns))
+    return query.options(*options)
+
+
+def query_validators(query, count=False):
+    """
+    Return a (last_modified, count) tuple for the objects of query, with
+    `max(modified)` and, when `count` is true, the count of them taken in a
+    single query. Returns `None` when the queried model has no `modified`
+    column.
+    """
+    column = getattr(query_entity(query), 'modified', None)
+    if column is None:
+        return None
+    sub = query.order_by(None).subquery()
+    modified = sub.corresponding_column(column.property.columns[0])
+    if not count:
+        return (query.session.query(func.max(modified))
+                             .select_from(sub).scalar(), None)
+    return tuple(query.session.query(func.max(modified), func.count())
+                              .select_from(sub).one())
+
+def make_etag(last_modified, count=None):
+    "Return a weak etag for the current request and the given validators"
+    value = '{}|{}|{}'.format(request.full_path, last_modified, count)
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+def not_modified(etag, last_modified):
+    """
+    Return if the client copy is fresh according to If-None-Match or, when
+    not given, If-Modified-Since headers.
+
+    Deleting an object that isn't the last modified one leaves max(modified)
+    untouched, so for collections only the etag notices it, when it includes
+    the count.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        since = datetime.fromtimestamp(calendar.timegm(since.utctimetuple()))
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+def set_validators(response, etag, last_modified):
+    "Set ETag and Last-Modified (from naive local time) on response"
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = datetime.utcfromtimestamp(
+            time.mktime(last_modified.timetuple())
+        )
+    return response
+
+
+def build_result(query, schema, key=None, profile=None, conditional=False):
+    """
+    Return a json response with `query` serialized through `schema`.
+
+    Collections are paginated with `page` and `per_page` request params. When
+    the `after` param is given on a query, keyset pagination by `key` (the
+    primary key by default) is used instead, starting after the given cursor
+    (empty to start from the begining) and returning the `next` cursor.
+
+    The `count` param selects how `num_results` is computed, see
+    `count_query`, the kind of count returned goes in `count_type`.
+
+    Fields to serialize can be restricted with `select` and `omit` params,
+    for queries the restriction is also applied to loaded columns. When a
+    :class:`nbs.utils.loading.LoadingProfile` is given, relationships needed
+    by the requested fields are loaded in bulk.
+
+    With the `stream` param collections are streamed, see `stream_result`.
+
+    With `conditional`, responses of queries and objects with a `modified`
+    attribute carry ETag and Last-Modified headers, from `max(modified)` for
+    queries, so it should only be enabled where `modified` is indexed.
+    Conditional requests matching them get a 304 before anything is loaded
+    or serialized. Pages with an `exact` count add the count to the etag,
+    taken along `max(modified)` and reused as `num_results`. Keyset pages,
+    streams and `none` counts get no validators. Set `CONDITIONAL_REQUESTS`
+    config to `False` to disable them everywhere.
+    """
+    validators = None
+    if not conditional or \
+            not current_app.config.get('CONDITIONAL_REQUESTS', True):
+        pass
+    elif is_query(query):
+        if request.after is None and request.count != 'none' and \
+                not request.stream_result:
+            validators = query_validators(query,
+                                          count=request.count == 'exact')
+    elif not is_collection(query) and \
+            getattr(query, 'modified', None) is not None:
+        validators = (query.modified, None)
+    if validators is not None:
+        etag = make_etag(*validators)
+        if not_modified(etag, validators[0]):
+            return set_validators(Response(status=304), etag, validators[0])
+        response = _build_result(query, schema, key, profile, validators[1])
+        return set_validators(response, etag, validators[0])
+    return _build_result(query, schema, key, profile)
+
+def _build_result(query, schema, key=None, profile=None, total=None):
+    if request.stream_result and is_collection(query):
+        return stream_result(query, schema, key, profile)
+
+    only = requested_fields(schema)
+    serializer = get_serializer(schema, only)
 
-        out = {
-            'num_results': result.total,
-            'page': result.page,
-            'num_pages': result.pages,
-        }
+    if is_collection(query):
+        if is_query(query):
+            if profile is not None:
+                query = profile.apply(query, only)
+            if request.after is not None:
+                if key is None:
+                    key = query_entity(query).id
+                if only:
+                    query = project_query(query, schema, only, (key.key,))
+                result = KeysetPagination(query, key, request.after,
+                                          request.per_page)
+            else:
+                if only:
+                    query = project_query(query, schema, only)
+                result = QueryPagination(query, request.page,
+                                         request.per_page, request.count,
+                                         total)
+        else:
+            result = Pagination(query, request.page, request.per_page,
+                                request.count)
+
+        if isinstance(result, KeysetPagination):
+            out = {
+                'next': result.next,
+                'per_page': result.per_page,
+            }
+        else:
+            out = {
+                'num_results': result.total,
+                'count_type': result.count_type,
+                'page': result.page,
+                'num_pages': result.pages,
+            }
         items = result.items
+        if profile is not None:
+            profile.prefetch(items, only)
 
     else:
         items = query
 
-    if request.select or request.omit:
-        schema = copy.copy(schema)
-        if list(request.select)[0]:
-            schema.only = request.select.intersection(schema.fields.keys())
-        if list(request.omit)[0]:
-            only_set = set(schema.only or schema.fields.keys())
-            schema.only = only_set.difference(request.omit)
-
-        if schema.only:
-            schema.only.add('id')
-
     if is_collection(items):
-        out['objects'] = schema.dump(items, many=True).data
+        out['objects'] = serializer.dump(items, many=True)
     else:
-        out = schema.dump(items, many=False).data
+        out = serializer.dump(items, many=False)
 
     return jsonify(out)
+
+
+def iter_chunks(query, key, size, after=None):
+    """
+    Yield lists of up to size objects from query, walking it by key.
+
+    Each chunk is fetched with its own keyset query, so only one chunk of
+    objects is alive at a time and the cost of a chunk doesn't depend on how
+    far into the result it is.
+    """
+    query = query.order_by(None).order_by(key)
+    while True:
+        q = query if after is None else query.filter(key > after)
+        chunk = q.limit(size).all()
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        after = getattr(chunk[-1], key.key)
+
+
+def iter_dumped(query, schema, key=None, profile=None):
+    """
+    Return an iterator of lists of serialized objects from query (or any
+    iterable), one chunk of `STREAM_CHUNK_SIZE` objects at a time.
+
+    Queries are walked by `key` (the primary key by default), starting after
+    the `after` cursor when given.
+    """
+    size = current_app.config.get('STREAM_CHUNK_SIZE', 500)
+    only = requested_fields(schema)
+    serializer = get_serializer(schema, only)
+
+    if is_query(query):
+        if key is None:
+            key = query_entity(query).id
+        if only:
+            query = project_query(query, schema, only, (key.key,))
+        if profile is not None:
+            query = profile.apply(query, only)
+        after = decode_cursor(request.after) if request.after else None
+        chunks = iter_chunks(query, key, size, after)
+    else:
+        iterator = iter(query)
+        chunks = iter(lambda: list(islice(iterator, size)), [])
+
+    def dumped():
+        for chunk in chunks:
+            if profile is not None:
+                profile.prefetch(chunk, only)
+            yield serializer.dump(chunk, many=True)
+    return dumped()
+
+
+def stream_result(query, schema, key=None, profile=None):
+    """
+    Return a streamed json response with all the objects of query.
+
+    The envelope and objects are written as they are serialized, a chunk at a
+    time (see `iter_dumped`), so time to first byte and memory don't grow with
+    the size of the result. `num_results` is written at the end.
+    """
+    chunks = iter_dumped(query, schema, key, profile)
+
+    def generate():
+        total = 0
+        yield '{"objects": ['
+        for data in chunks:
+            sep = ', ' if total else ''
+            yield sep + ', '.join(json_dumps(o) for o in data)
+            total += len(data)
+        yield '], "num_results": {}}}'.format(total)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def fetch_many(query, ids, chunk_size=500):
+    """
+    Return a tuple (objects, missing) for the given ids.
+
+    Objects are fetched with one IN query per `chunk_size` ids and returned
+    in the order of ids, missing holds the ids that weren't found.
+    """
+    entity = query_entity(query)
+    ids = list(OrderedDict.fromkeys(ids))
+    found = {}
+    for i in range(0, len(ids), chunk_size):
+        for obj in query.filter(entity.id.in_(ids[i:i+chunk_size])):
+            found[obj.id] = obj
+    objects = [found[id] for id in ids if id in found]
+    missing = [id for id in ids if id not in found]
+    return objects, missing
+
+
+def build_many(query, ids, schema, profile=None):
+    """
+    Return a json response with the objects of query with the given ids,
+    in the requested order, and the list of `missing` ids.
+    """
+    max_ids = current_app.config.get('MAX_ITEMS_PER_BATCH', 1000)
+    if len(ids) > max_ids:
+        abort(400, message='Too many ids requested, max is {}'.format(max_ids))
+
+    only = requested_fields(schema)
+    if only:
+        query = project_query(query, schema, only)
+    if profile is not None:
+        query = profile.apply(query, only)
+
+    objects, missing = fetch_many(query, ids)
+    if profile is not None:
+        profile.prefetch(objects, only)
+    return jsonify({
+        'num_results': len(objects),
+        'objects': get_serializer(schema, only).dump(objects, many=True),
+        'missing': missing,
+    })
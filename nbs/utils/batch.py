@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.batch
+    ~~~~~~~~~~~~~~~
+
+    Batch writes, lists of create, update and delete operations validated
+    together and applied in a single transaction.
+"""
+
+import copy
+
+from flask import current_app, jsonify
+from sqlalchemy.exc import IntegrityError
+from webargs.flaskparser import abort
+
+from nbs.models import db
+from nbs.utils.api import fetch_many
+from nbs.utils.unique import (
+    check_unique, integrity_messages, unique_columns
+)
+
+BATCH_OPS = ('create', 'update', 'delete')
+BATCH_MODES = ('atomic', 'partial')
+
+#: status of valid operations not applied because others failed
+NOT_APPLIED = 424
+
+
+def load_item(schema, data, partial=False):
+    """
+    Return (result, errors) loading data through schema.
+
+    When partial, only the fields present in data are validated and result
+    is a dict of attributes even if the schema makes objects.
+    """
+    loader = copy.copy(schema)
+    loader.strict = False
+    if partial:
+        loader.make_object = dict
+    result, errors = loader.load(data)
+    if partial:
+        errors = dict((k, v) for k, v in errors.items() if k in data)
+    return result, errors
+
+
+class Operation(object):
+    "An operation of a batch and its outcome"
+
+    def __init__(self, index, op, id=None, data=None):
+        self.index = index
+        self.op = op
+        self.id = id
+        self.data = data
+        self.obj = None
+        self.status = None
+        self.messages = None
+
+    def fail(self, status, messages):
+        self.status, self.messages = status, messages
+
+    def apply(self, session):
+        if self.op == 'create':
+            session.add(self.obj)
+        elif self.op == 'update':
+            for k, v in self.data.items():
+                setattr(self.obj, k, v)
+        else:
+            session.delete(self.obj)
+
+    def result(self):
+        out = {'index': self.index, 'status': self.status}
+        if self.obj is not None and self.status in (200, 201):
+            out['id'] = self.obj.id
+        elif self.id is not None:
+            out['id'] = self.id
+        if self.messages:
+            out['messages'] = self.messages
+        return out
+
+
+def parse_operations(payload):
+    "Return the list of Operation in payload, aborting when malformed"
+    if not isinstance(payload, dict) or \
+            not isinstance(payload.get('operations'), list):
+        abort(400, message='Expected an object with a list of operations')
+    items = payload['operations']
+    max_items = current_app.config.get('MAX_ITEMS_PER_BATCH', 1000)
+    if len(items) > max_items:
+        abort(400, message='Too many operations, max is {}'.format(max_items))
+
+    operations = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            item = {}
+        op = Operation(index, item.get('op'), item.get('id'),
+                       item.get('data'))
+        if op.op not in BATCH_OPS:
+            op.fail(400, {'op': ['Must be one of {}'.format(
+                ', '.join(BATCH_OPS))]})
+        elif op.op != 'create' and not isinstance(op.id, int):
+            op.fail(400, {'id': ['Integer id required']})
+        elif op.op != 'delete' and not isinstance(op.data, dict):
+            op.fail(400, {'data': ['Object required']})
+        operations.append(op)
+    return operations
+
+
+def _prepare(view, operations):
+    "Load data and targets of operations, failing the invalid ones"
+    model, schema = view.batch_model, view.batch_schema
+    defaults = view.batch_defaults(view.obj)
+
+    targets = [op for op in operations
+               if op.status is None and op.op != 'create']
+    found, _ = fetch_many(view.batch_query(view.obj),
+                          [op.id for op in targets])
+    found = dict((obj.id, obj) for obj in found)
+
+    for op in operations:
+        if op.status is not None:
+            continue
+        if op.op != 'create':
+            op.obj = found.get(op.id)
+            if op.obj is None:
+                op.fail(404, {'id': ['Not found']})
+                continue
+        if op.op == 'delete':
+            continue
+        result, errors = load_item(schema, dict(op.data, **defaults),
+                                   partial=op.op == 'update')
+        if errors:
+            op.fail(400, errors)
+        elif op.op == 'create':
+            op.obj = model(**result) if isinstance(result, dict) else result
+        else:
+            op.data = result
+
+    keys = list(unique_columns(model)) + \
+           list(getattr(model, '__unique_fields__', ()))
+    writes = [op for op in operations
+              if op.status is None and op.op != 'delete']
+    rows = []
+    for op in writes:
+        if op.op == 'create':
+            rows.append(dict((k, getattr(op.obj, k)) for k in keys))
+        else:
+            rows.append(dict(((k, op.data.get(k, getattr(op.obj, k)))
+                              for k in keys), id=op.id))
+    # check against the state after the batch, values of updated and
+    # deleted objects are free, real conflicts are left to the constraints
+    replaced = [op.id for op in operations
+                if op.status is None and op.op != 'create']
+    with db.session.no_autoflush:
+        conflicts = check_unique(model, rows, keys, replaced)
+    for idx, messages in conflicts.items():
+        writes[idx].fail(409, messages)
+
+
+def _done(op):
+    op.status = {'create': 201, 'update': 200, 'delete': 204}[op.op]
+
+
+def apply_batch(view, payload, mode='atomic'):
+    """
+    Apply the operations in payload on the model of view and return a json
+    response with the result of each one.
+
+    In `atomic` mode nothing is written when any operation fails, changes
+    are flushed at once when all of them are valid. In `partial` mode each
+    valid operation is applied in its own savepoint, so the ones failing on
+    the database don't undo the others.
+    """
+    if mode not in BATCH_MODES:
+        abort(400, message='Invalid batch mode')
+    operations = parse_operations(payload)
+    _prepare(view, operations)
+    model = view.batch_model
+    session = db.session
+    failed = [op for op in operations if op.status is not None]
+    status = 200
+
+    if mode == 'atomic':
+        if failed:
+            status = failed[0].status
+            for op in operations:
+                if op.status is None:
+                    op.status = NOT_APPLIED
+            session.rollback()
+        else:
+            for op in operations:
+                op.apply(session)
+            try:
+                session.commit()
+            except IntegrityError as e:
+                session.rollback()
+                messages = integrity_messages(model, e) or \
+                           {'_schema': [str(e.orig)]}
+                abort(409, message='Conflict', messages=messages)
+            for op in operations:
+                _done(op)
+    else:
+        for op in operations:
+            if op.status is not None:
+                continue
+            try:
+                with session.begin_nested():
+                    op.apply(session)
+            except IntegrityError as e:
+                op.fail(409, integrity_messages(model, e) or
+                        {'_schema': [str(e.orig)]})
+            else:
+                _done(op)
+        session.commit()
+
+    return jsonify({
+        'mode': mode,
+        'num_results': len(operations),
+        'failed': sum(1 for op in operations
+                      if op.status not in (200, 201, 204)),
+        'objects': [op.result() for op in operations],
+    }), status
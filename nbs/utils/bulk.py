@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.bulk
+    ~~~~~~~~~~~~~~
+
+    Bulk loading helpers, record readers and set-based upserts.
+"""
+
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+
+from dateutil.parser import parse
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+
+from nbs.models import db
+
+BULK_FORMATS = ('csv', 'ndjson')
+
+#: `dat` is the tab separated attendance log of the time clocks
+PUNCH_FORMATS = ('dat',) + BULK_FORMATS
+PUNCH_FIELDS = ('user_code', 'datetime', 'bkp_type', 'type_code')
+
+#: max number of bind parameters used in a single IN clause
+IN_CHUNK_SIZE = 500
+
+
+def read_records(lines, fmt):
+    """
+    Yield (lineno, record, error) tuples from an iterable of text lines in
+    `csv` (with header) or `ndjson` format.
+
+    Empty CSV values are left out of the record, so they are taken as missing
+    instead of overwriting stored values.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            record = dict((k, v) for k, v in record.items()
+                          if k is not None and v not in ('', None))
+            yield reader.line_num, record, None
+    else:
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield lineno, None, str(e)
+                continue
+            if not isinstance(record, dict):
+                yield lineno, None, 'Record must be an object'
+                continue
+            yield lineno, record, None
+
+
+def _punch(record):
+    "Return a punch row from a raw record, raise ValueError if invalid"
+    missing = [f for f in PUNCH_FIELDS if record.get(f) in ('', None)]
+    if missing:
+        raise ValueError('Missing {}'.format(', '.join(missing)))
+    value = record['datetime']
+    try:
+        dt = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except (ValueError, TypeError):
+        dt = parse(value)
+        if dt.tzinfo is not None:
+            raise ValueError('Datetime must be local time')
+    return {
+        'user_code': int(record['user_code']),
+        'datetime': dt,
+        'bkp_type': int(record['bkp_type']),
+        'type_code': int(record['type_code']),
+    }
+
+def read_punches(lines, fmt):
+    """
+    Yield (lineno, punch, error) tuples from an iterable of text lines in
+    `dat` (time clock log), `csv` or `ndjson` format, punches being dicts
+    with the `AttendanceRecord` columns.
+    """
+    if fmt == 'dat':
+        records = ((lineno, dict(zip(PUNCH_FIELDS,
+                                     (v.strip() for v in line.split('\t')))),
+                    None)
+                   for lineno, line in enumerate(lines, 1) if line.strip())
+    else:
+        records = read_records(lines, fmt)
+    for lineno, record, error in records:
+        if error is None:
+            try:
+                record = _punch(record)
+            except (ValueError, TypeError, OverflowError) as e:
+                record, error = None, str(e)
+        yield lineno, record, error
+
+
+def batched(iterable, size):
+    "Yield lists of up to size items from iterable"
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def _columns(mapper, row):
+    "Return row with attribute keys translated to column keys"
+    return dict((mapper.get_property(k).columns[0].key, v)
+                for k, v in row.items())
+
+
+def upsert(model, rows, key):
+    """
+    Insert or update rows (dicts keyed by attribute name) of model, matching
+    existing ones by the unique `key` attribute.
+
+    PostgreSQL uses a single ``INSERT ... ON CONFLICT DO UPDATE`` statement,
+    other databases look up existing keys with one IN query per chunk and
+    apply bulk inserts and updates.
+    """
+    if not rows:
+        return
+    session = db.session
+    table = model.__table__
+    mapper = sa_inspect(model)
+    key_col = mapper.get_property(key).columns[0]
+
+    if session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        # a multi values insert needs the same keys on every row
+        groups = {}
+        for row in rows:
+            groups.setdefault(frozenset(row), []).append(_columns(mapper, row))
+        for group in groups.values():
+            stmt = pg_insert(table).values(group)
+            update = dict((c, stmt.excluded[c]) for c in group[0]
+                          if c != key_col.key)
+            if 'modified' in table.c:
+                update['modified'] = datetime.now()
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=[key_col], set_=update
+            ))
+        return
+
+    existing = {}
+    keys = [row[key] for row in rows]
+    pk = getattr(model, 'id')
+    attr = getattr(model, key)
+    for i in range(0, len(keys), IN_CHUNK_SIZE):
+        q = session.query(attr, pk).filter(attr.in_(keys[i:i+IN_CHUNK_SIZE]))
+        existing.update(q)
+
+    inserts = [row for row in rows if row[key] not in existing]
+    updates = [dict(row, id=existing[row[key]]) for row in rows
+               if row[key] in existing]
+    if inserts:
+        session.bulk_insert_mappings(model, inserts)
+    if updates:
+        session.bulk_update_mappings(model, updates)
+
+
+def insert_ignore(model, rows, key):
+    """
+    Insert rows (dicts keyed by column name) of model, skipping the ones whose
+    unique `key` column is already stored. Returns the number of rows
+    inserted.
+
+    PostgreSQL uses ``INSERT ... ON CONFLICT DO NOTHING`` and SQLite
+    ``INSERT OR IGNORE``, other databases look up existing keys with one IN
+    query per chunk before inserting.
+    """
+    if not rows:
+        return 0
+    session = db.session
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        inserted = 0
+        for chunk in batched(rows, IN_CHUNK_SIZE):
+            stmt = pg_insert(table).values(chunk)
+            inserted += session.execute(stmt.on_conflict_do_nothing(
+                index_elements=[table.c[key]]
+            )).rowcount
+        return inserted
+
+    if dialect == 'sqlite':
+        stmt = table.insert().prefix_with('OR IGNORE')
+        return session.execute(stmt, rows).rowcount
+
+    column = table.c[key]
+    existing = set()
+    keys = list(set(row[key] for row in rows))
+    for i in range(0, len(keys), IN_CHUNK_SIZE):
+        q = session.query(column).filter(column.in_(keys[i:i+IN_CHUNK_SIZE]))
+        existing.update(k for k, in q)
+    inserts = {}
+    for row in rows:
+        if row[key] not in existing:
+            inserts.setdefault(row[key], row)
+    if inserts:
+        session.execute(table.insert(), list(inserts.values()))
+    return len(inserts)
+
+
+def import_punches(records, batch_size=5000, max_errors=1000):
+    """
+    Insert punches from (lineno, punch, error) records as returned by
+    :func:`read_punches`, skipping the ones already stored (by `datetime`).
+
+    Punches are inserted and committed a batch at a time, then the
+    attendance summaries of the days that got new punches are refreshed.
+    Returns a report dict with the number of `rows` read, punches
+    `inserted` and `skipped`, and up to `max_errors` per row `errors`.
+    """
+    from nbs.models.hr import AttendanceRecord, AttendanceSummary
+    report = {'rows': 0, 'inserted': 0, 'skipped': 0, 'errors': []}
+    days = set()
+
+    for batch in batched(records, batch_size):
+        report['rows'] += len(batch)
+        rows = []
+        for lineno, punch, error in batch:
+            if error is not None:
+                if len(report['errors']) < max_errors:
+                    report['errors'].append({'row': lineno,
+                                             'messages': {'_record': [error]}})
+            else:
+                rows.append(punch)
+
+        inserted = insert_ignore(AttendanceRecord, rows, 'datetime')
+        db.session.commit()
+        report['inserted'] += inserted
+        report['skipped'] += len(rows) - inserted
+        if inserted:
+            days.update((r['user_code'], r['datetime'].date()) for r in rows)
+
+    if days:
+        AttendanceSummary.refresh(days)
+        db.session.commit()
+    return report
+
+
+def bulk_import(model, schema, key, records, batch_size=500, max_errors=1000):
+    """
+    Validate records through schema and upsert them on model by `key`, one
+    transaction per batch of `batch_size` records.
+
+    `records` is an iterable of (lineno, record, error) as returned by
+    :func:`read_records`, only one batch is held in memory at a time. When a
+    batch fails on the database it is retried row by row to report the rows
+    at fault. Returns a report dict with the number of `rows` read, the
+    number of rows `imported` and up to `max_errors` per row `errors`.
+    """
+    report = {'rows': 0, 'imported': 0, 'errors': []}
+
+    def add_error(lineno, messages):
+        if len(report['errors']) < max_errors:
+            report['errors'].append({'row': lineno, 'messages': messages})
+
+    for batch in batched(records, batch_size):
+        report['rows'] += len(batch)
+        lines, raw = [], []
+        for lineno, record, error in batch:
+            if error is not None:
+                add_error(lineno, {'_record': [error]})
+            else:
+                lines.append(lineno)
+                raw.append(record)
+
+        data, errors = schema.load(raw, many=True)
+        valid = {}
+        for idx, (lineno, row) in enumerate(zip(lines, data)):
+            if idx in errors:
+                add_error(lineno, errors[idx])
+            else:
+                # last occurrence of a key wins
+                valid[row[key]] = (lineno, row)
+
+        try:
+            upsert(model, [row for _, row in valid.values()], key)
+            db.session.commit()
+            report['imported'] += len(valid)
+        except IntegrityError:
+            db.session.rollback()
+            for lineno, row in valid.values():
+                try:
+                    upsert(model, [row], key)
+                    db.session.commit()
+                    report['imported'] += 1
+                except IntegrityError as e:
+                    db.session.rollback()
+                    add_error(lineno, {'_record': [str(e.orig)]})
+
+    return report
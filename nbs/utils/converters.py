@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
 
+from flask import current_app
 from werkzeug.routing import BaseConverter
+from webargs.flaskparser import abort
+
+
+def check_size(size):
+    "Abort with 400 when size is over the max number of items of a batch"
+    max_ids = current_app.config.get('MAX_ITEMS_PER_BATCH', 1000)
+    if size > max_ids:
+        abort(400, message='Too many ids requested, max is {}'.format(max_ids))
 
 
 class ListConverter(BaseConverter):
@@ -38,6 +47,7 @@ class RangeConverter(BaseConverter):
 
     def to_python(self, value):
         s, e = value.split('-')
+        check_size(int(e) - int(s) + 1)
         return list(range(int(s), int(e)+1))
 
     def to_url(self, value):
@@ -49,6 +59,9 @@ class RangeListConverter(BaseConverter):
     regex = '(?:\d+|\d+-\d+)+(?:,(?:\d+|\d+-\d+))*'
 
     def to_python(self, value):
+        # ranges are measured before expanding them
+        groups = [gr.split('-') for gr in value.split(',')]
+        check_size(sum(max(int(g[-1]) - int(g[0]) + 1, 0) for g in groups))
         retval = []
         for gr in value.split(','):
             if '-' in gr:
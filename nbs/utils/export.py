@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.export
+    ~~~~~~~~~~~~~~~~
+
+    Bulk export of whole collections as NDJSON or CSV streams.
+"""
+
+import io
+import csv
+import calendar
+from datetime import datetime
+
+from dateutil.parser import parse
+from flask import request, Response, stream_with_context
+from flask.json import dumps as json_dumps
+from webargs.flaskparser import abort
+
+from nbs.utils.api import iter_dumped, requested_fields
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def _local_naive(dt):
+    "Return dt as a naive local datetime, naive values are taken as UTC"
+    return datetime.fromtimestamp(calendar.timegm(dt.utctimetuple()))
+
+def modified_since():
+    """
+    Return the datetime given in `since` param or If-Modified-Since header,
+    as a naive local datetime like the ones stored by `TimestampMixin`.
+    """
+    since = request.args.get('since')
+    if since:
+        try:
+            since = parse(since)
+        except (ValueError, OverflowError):
+            abort(400, message='Invalid since parameter')
+        if since.tzinfo is not None:
+            since = _local_naive(since)
+        return since
+    if request.if_modified_since is not None:
+        return _local_naive(request.if_modified_since)
+    return None
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json_dumps(value)
+    return value
+
+def _ndjson(chunks):
+    for data in chunks:
+        yield ''.join(json_dumps(o) + '\n' for o in data)
+
+def _csv(chunks, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    yield buf.getvalue()
+    for data in chunks:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([_csv_value(o.get(c)) for c in columns]
+                         for o in data)
+        yield buf.getvalue()
+
+
+def export_result(query, schema, name, key=None, modified=None,
+                  profile=None):
+    """
+    Return a streamed response with all objects of query serialized through
+    schema, as NDJSON (default) or CSV according to the `format` param.
+
+    When `modified` column is given, objects are filtered with the value of
+    :func:`modified_since`. Objects are read and written a chunk at a time,
+    see :func:`nbs.utils.api.iter_dumped`.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        abort(400, message='Invalid export format')
+
+    if modified is not None:
+        since = modified_since()
+        if since is not None:
+            query = query.filter(modified > since)
+
+    chunks = iter_dumped(query, schema, key, profile)
+    if fmt == 'csv':
+        names = requested_fields(schema) or schema.fields.keys()
+        columns = sorted(names, key=lambda n: (n != 'id', n))
+        body = _csv(chunks, columns)
+    else:
+        body = _ndjson(chunks)
+
+    headers = {
+        'Content-Disposition': 'attachment; filename={}.{}'.format(name, fmt),
+    }
+    return Response(stream_with_context(body), mimetype=EXPORT_FORMATS[fmt],
+                    headers=headers)
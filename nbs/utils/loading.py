@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.loading
+    ~~~~~~~~~~~~~~~~~
+
+    Loading profiles, eager loading strategies derived from the fields a
+    schema is going to serialize.
+"""
+
+from collections import defaultdict
+
+from marshmallow import fields
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import joinedload, subqueryload, lazyload
+try:
+    from sqlalchemy.orm import selectinload
+except ImportError: # SQLAlchemy < 1.2
+    selectinload = subqueryload
+
+from nbs.utils.api import requested_fields
+
+#: how deep nested schemas are followed to build eager options
+MAX_DEPTH = 3
+
+
+def schema_fields(schema, only=None):
+    "Return a dict with the fields schema serializes, restricted to only"
+    return dict((name, field) for name, field in schema.fields.items()
+                if not only or name in only)
+
+
+def _chain(parent, loader, key):
+    if parent is None:
+        return loader(key)
+    return getattr(parent, loader.__name__)(key)
+
+
+def _field_relations(mapper, field_dict):
+    """
+    Return a dict relationship key -> list of (field, subattrs) for the
+    relationships of mapper used by fields in field_dict.
+    """
+    used = defaultdict(list)
+    for name, field in field_dict.items():
+        parts = (field.attribute or name).split('.')
+        if parts[0] in mapper.relationships:
+            used[parts[0]].append((field, parts[1:]))
+    return used
+
+
+def eager_options(mapper, field_dict, parent=None, depth=0):
+    """
+    Return loader options to serialize field_dict from instances of mapper.
+
+    Collections are loaded with `selectinload`, scalar references with
+    `joinedload` and eager relationships not needed with `lazyload`.
+    Dynamic relationships are left alone, see `prefetch_dynamic`.
+    """
+    options = []
+    used = _field_relations(mapper, field_dict)
+
+    for rel in mapper.relationships:
+        if rel.key not in used and rel.lazy in ('joined', 'subquery'):
+            options.append(_chain(parent, lazyload, rel.key))
+
+    if depth >= MAX_DEPTH:
+        return options
+
+    for key, uses in used.items():
+        rel = mapper.relationships[key]
+        if rel.lazy == 'dynamic':
+            continue
+        loader = selectinload if rel.uselist else joinedload
+        option = _chain(parent, loader, key)
+        options.append(option)
+
+        sub_fields = {}
+        for field, subattrs in uses:
+            if isinstance(field, fields.Nested):
+                sub_fields.update(field.schema.fields)
+            elif subattrs:
+                attr = '.'.join(subattrs)
+                sub_fields[attr] = fields.Field(attribute=attr)
+        options.extend(eager_options(rel.mapper, sub_fields, option,
+                                     depth+1))
+    return options
+
+
+def prefetch_dynamic(objects, mapper, field_dict):
+    """
+    Load the dynamic relationships used by field_dict for all objects with
+    one query per relationship. Results are stored in the `_prefetched` dict
+    of each object, where `nbs.schema.DynamicNested` fields look for them.
+    """
+    if not objects:
+        return
+    session = sa_inspect(objects[0]).session
+
+    for key in _field_relations(mapper, field_dict):
+        rel = mapper.relationships[key]
+        if rel.lazy != 'dynamic' or len(rel.local_remote_pairs) != 1:
+            continue
+        (local, remote), = rel.local_remote_pairs
+        local_key = mapper.get_property_by_column(local).key
+        remote_attr = getattr(rel.mapper.class_,
+                              rel.mapper.get_property_by_column(remote).key)
+
+        values = set(getattr(o, local_key) for o in objects)
+        query = session.query(rel.mapper).filter(remote_attr.in_(values))
+        if rel.order_by:
+            query = query.order_by(*rel.order_by)
+
+        groups = defaultdict(list)
+        for child in query:
+            groups[getattr(child, remote_attr.key)].append(child)
+
+        for o in objects:
+            if getattr(o, '_prefetched', None) is None:
+                o._prefetched = {}
+            o._prefetched[key] = groups.get(getattr(o, local_key), [])
+
+
+class LoadingProfile(object):
+    """
+    Loading profile of an endpoint serializing `model` through `schema`.
+
+    Eager options and dynamic relationships prefetching are derived from the
+    fields requested to the schema, so serializing a page costs a fixed number
+    of queries no matter how many rows it has.
+    """
+
+    def __init__(self, model, schema):
+        self.model = model
+        self.schema = schema
+        self.mapper = sa_inspect(model)
+        self._options = {}
+
+    def options(self, only=None):
+        key = frozenset(only or ())
+        if key not in self._options:
+            self._options[key] = eager_options(
+                self.mapper, schema_fields(self.schema, only)
+            )
+        return self._options[key]
+
+    def apply(self, query, only=None):
+        "Return query with the eager options for only fields"
+        return query.options(*self.options(only))
+
+    def prefetch(self, objects, only=None):
+        "Prefetch dynamic relationships for objects"
+        prefetch_dynamic(list(objects), self.mapper,
+                         schema_fields(self.schema, only))
+
+    def get_or_404(self, id, query=None):
+        "Return the instance with id loaded for the requested fields"
+        only = requested_fields(self.schema)
+        if query is None:
+            query = self.model.query
+        obj = self.apply(query, only).get_or_404(id)
+        self.prefetch([obj], only)
+        return obj
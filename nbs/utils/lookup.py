@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.lookup
+    ~~~~~~~~~~~~~~~~
+
+    In process product lookup by sku or barcode, for POS scanning.
+"""
+
+import time
+import threading
+from datetime import timedelta
+from collections import namedtuple
+
+from flask.json import dumps as json_dumps
+
+from nbs.models import db, Product
+
+LookupEntry = namedtuple("LookupEntry",
+                         "id sku barcode short_description price status")
+
+#: columns loaded from products, in `LookupEntry` order
+LOOKUP_COLUMNS = (Product.id, Product.sku, Product.barcode,
+                  Product.short_description, Product.price, Product.status,
+                  Product.modified)
+
+
+class ProductLookup(object):
+    """
+    Hash index of the hot fields of all products by sku and barcode.
+
+    Entries are kept with their json already rendered, so answering a lookup
+    is two dict gets on the current snapshot of the index, lookups never
+    touch the database. A background thread updates it with the products
+    modified since the last refresh every `refresh_interval` seconds,
+    looking back `overlap` seconds to catch transactions committed late.
+    Deletes are only noticed by the full reload it does every
+    `reload_interval` seconds. Changes are made on copies swapped in with a
+    single assignment.
+    """
+
+    def __init__(self, refresh_interval=5, reload_interval=3600, overlap=60):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.overlap = timedelta(seconds=overlap)
+        #: current snapshot, (entries by id, ids by code)
+        self.index = ({}, {})
+        self.last_modified = None
+        self.refreshed_at = self.loaded_at = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def configure(self, app):
+        """
+        Take intervals from app config, load on the first request and start
+        the refresh thread
+        """
+        self.refresh_interval = app.config.get('LOOKUP_REFRESH_INTERVAL',
+                                               self.refresh_interval)
+        self.reload_interval = app.config.get('LOOKUP_RELOAD_INTERVAL',
+                                              self.reload_interval)
+
+        @app.before_first_request
+        def start_lookup():
+            self.load()
+            self.start(app)
+
+    def _add(self, entries, codes, row):
+        entry = LookupEntry(row.id, row.sku, row.barcode,
+                            row.short_description,
+                            '{:.2f}'.format(row.price)
+                            if row.price is not None else None, row.status)
+        old = entries.get(entry.id)
+        if old is not None:
+            for code in old[0].sku, old[0].barcode:
+                if codes.get(code) == entry.id:
+                    del codes[code]
+        entries[entry.id] = (entry, json_dumps(entry._asdict()))
+        codes[entry.sku] = entry.id
+        if entry.barcode:
+            codes[entry.barcode] = entry.id
+        if row.modified is not None and (self.last_modified is None or
+                                         row.modified > self.last_modified):
+            self.last_modified = row.modified
+
+    def load(self):
+        """
+        Load the whole index, replacing the current one when done. Lookups
+        are served from the current one meanwhile.
+        """
+        with self._lock:
+            entries, codes = {}, {}
+            self.last_modified = None
+            q = db.session.query(*LOOKUP_COLUMNS).yield_per(5000)
+            for row in q:
+                self._add(entries, codes, row)
+            self.index = (entries, codes)
+            self.refreshed_at = self.loaded_at = time.time()
+
+    def refresh(self):
+        "Update the index with products modified since the last refresh"
+        with self._lock:
+            q = db.session.query(*LOOKUP_COLUMNS)
+            if self.last_modified is not None:
+                q = q.filter(Product.modified>=self.last_modified-self.overlap)
+            rows = q.all()
+            if rows:
+                entries, codes = [dict(d) for d in self.index]
+                for row in rows:
+                    self._add(entries, codes, row)
+                self.index = (entries, codes)
+            self.refreshed_at = time.time()
+
+    def maybe_refresh(self):
+        "Reload or refresh the index when due"
+        now = time.time()
+        if now - self.loaded_at >= self.reload_interval:
+            self.load()
+        elif now - self.refreshed_at >= self.refresh_interval:
+            self.refresh()
+
+    def start(self, app):
+        "Start the thread keeping the index fresh, once per process"
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,),
+                                            name='product-lookup')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, app):
+        while True:
+            time.sleep(self.refresh_interval)
+            with app.app_context():
+                try:
+                    self.maybe_refresh()
+                except Exception:
+                    app.logger.exception('Product lookup refresh failed')
+                finally:
+                    db.session.remove()
+
+    def get(self, code):
+        "Return (entry, json) for the product with sku or barcode code"
+        entries, codes = self.index
+        id = codes.get(code)
+        if id is None:
+            return None
+        return entries.get(id)
+
+
+product_lookup = ProductLookup()
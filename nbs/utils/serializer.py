@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.serializer
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Cache of projected schemas, copies of a schema restricted to the
+    requested fields kept with an LRU bound so they aren't made again for
+    every request. Dumping is still done by the schema itself.
+"""
+
+import copy
+from functools import lru_cache
+
+#: max number of (schema, fields) combinations kept
+SERIALIZER_CACHE_SIZE = 256
+
+
+class CachedSerializer(object):
+    "Projection of `schema` to `only` fields, dumped with `Schema.dump`"
+
+    def __init__(self, schema, only=None):
+        if only:
+            schema = copy.copy(schema)
+            schema.only = set(only)
+        self.schema = schema
+
+    def dump(self, obj, many=False):
+        "Return serialized data for obj"
+        return self.schema.dump(obj, many=many).data
+
+
+@lru_cache(maxsize=SERIALIZER_CACHE_SIZE)
+def _get_serializer(schema, only):
+    return CachedSerializer(schema, only)
+
+def get_serializer(schema, only=None):
+    "Return the cached projection of schema to only fields"
+    return _get_serializer(schema, frozenset(only) if only else None)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nbs.utils.unique
+    ~~~~~~~~~~~~~~~~
+
+    Uniqueness checks relying on database constraints, conflicts are
+    reported as 409 responses with per field messages.
+
+    Models can declare in `__unique_fields__` attributes that must be unique
+    but have no constraint backing them (ie. names shared in `entity`),
+    those are checked with a query before writing.
+"""
+
+from sqlalchemy import inspect as sa_inspect, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
+from webargs.flaskparser import abort
+
+from nbs.models import db
+from nbs.utils.bulk import IN_CHUNK_SIZE
+
+
+def unique_columns(model):
+    "Return a dict attribute key -> column for single column unique keys"
+    mapper = sa_inspect(model)
+    unique = set()
+    for table in mapper.tables:
+        unique.update(c for c in table.columns if c.unique)
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint) and \
+                    len(constraint.columns) == 1:
+                unique.update(constraint.columns)
+        unique.update(c for index in table.indexes
+                      if index.unique and len(index.columns) == 1
+                      for c in index.columns)
+    return dict((prop.key, prop.columns[0]) for prop in mapper.column_attrs
+                if prop.columns[0] in unique and not prop.key.startswith('_'))
+
+
+def unique_message(model, key):
+    return '{} {} must be unique'.format(model.__name__, key)
+
+
+def integrity_messages(model, error):
+    """
+    Return field messages for an IntegrityError raised writing model, or
+    None when the violated constraint isn't a known unique key.
+    """
+    text = str(error.orig)
+    for key, column in unique_columns(model).items():
+        table, name = column.table.name, column.name
+        hints = (
+            '{}.{}'.format(table, name),     # sqlite
+            '({})='.format(name),            # postgresql
+            '{}_{}_key'.format(table, name), # postgresql constraint
+            "key '{}'".format(name),         # mysql
+        )
+        if any(hint in text for hint in hints):
+            return {key: [unique_message(model, key)]}
+    return None
+
+
+def commit_unique(model):
+    """
+    Commit the session, aborting with 409 and the messages of the fields at
+    fault when it fails on a constraint.
+    """
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        messages = integrity_messages(model, e)
+        if messages is None:
+            messages = {'_schema': [str(e.orig)]}
+        abort(409, message='Conflict', messages=messages)
+
+
+def check_unique(model, rows, keys=None, replaced=()):
+    """
+    Return a dict row index -> field messages for rows (dicts keyed by
+    attribute name) that repeat a unique value of model, already stored or
+    in a previous row.
+
+    Existing values are looked up with one IN query per key and chunk of
+    values, rows with an `id` may keep their own values. Stored values of
+    objects with an id in `replaced` (updated or deleted along with rows)
+    are ignored, their new values are the ones in rows. By default all
+    unique columns and `__unique_fields__` of model are checked.
+    """
+    replaced = set(replaced)
+    if keys is None:
+        keys = list(unique_columns(model)) + \
+               list(getattr(model, '__unique_fields__', ()))
+    pk = getattr(model, 'id')
+    errors = {}
+
+    for key in keys:
+        values = list(set(row[key] for row in rows
+                          if row.get(key) is not None))
+        if not values:
+            continue
+        attr = getattr(model, key)
+        stored = {}
+        for i in range(0, len(values), IN_CHUNK_SIZE):
+            q = db.session.query(attr, pk)\
+                    .filter(attr.in_(values[i:i+IN_CHUNK_SIZE]))
+            stored.update((value, id) for value, id in q
+                          if id not in replaced)
+
+        seen = set()
+        for idx, row in enumerate(rows):
+            value = row.get(key)
+            if value is None:
+                continue
+            if value in seen or stored.get(value, row.get('id')) != \
+                    row.get('id'):
+                errors.setdefault(idx, {})[key] = [unique_message(model, key)]
+            seen.add(value)
+    return errors
+
+
+def ensure_unique(model, data, id=None):
+    """
+    Check `__unique_fields__` of model in data (a dict of attributes for
+    the instance with id, or a new one), aborting with 409 on conflict.
+    """
+    keys = [k for k in getattr(model, '__unique_fields__', ()) if k in data]
+    if not keys:
+        return
+    row = dict(data, id=id)
+    errors = check_unique(model, [row], keys)
+    if errors:
+        abort(409, message='Conflict', messages=errors[0])
@@ -1,6 +1,8 @@
 # -*- coding: utf-8-*-
 import re
 
+from nbs.utils.attendance import compile_worktime
+
 def validate_cuit(cuit):
     """
     Validates CUIT (Argentina) - Clave Única de Identificación Triebutaria
@@ -44,3 +46,14 @@ def validate_cbu(cbu):
     aux = sum([int(cbu[i+8])*base[i] for i in range(13)])
 
     return (10 - (aux % 10)) == int(cbu[21])
+
+
+def validate_worktime(spec):
+    "Validates worktime spec, a dict weekday -> list of [start, end] times"
+    if spec is None:
+        return True
+    try:
+        compile_worktime(spec)
+    except ValueError:
+        return False
+    return True
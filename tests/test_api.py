@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from nbs.models import Supplier
+from nbs.api.supplier import SupplierSchema
+from nbs.utils.api import project_query
+
+
+def selected_columns(query):
+    return set(c.name for c in query.statement.inner_columns)
+
+
+def test_project_query_follows_synonyms(db):
+    query = project_query(db.session.query(Supplier), SupplierSchema(),
+                          set(['id', 'name']))
+    columns = selected_columns(query)
+    assert 'name_1' in columns
+    assert 'customer_no' not in columns
+    assert 'payment_term' not in columns
+    assert 'name_2' not in columns
+
+
+def test_project_query_loads_all_for_properties(db):
+    # freight_type is read from a property, its columns are unknown
+    query = project_query(db.session.query(Supplier), SupplierSchema(),
+                          set(['id', 'freight_type']))
+    assert 'customer_no' in selected_columns(query)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+
+from nbs.utils.attendance import (
+    Punch, fixed_records, match_punches, perfect_grid
+)
+
+SLOTS = [time(8, 30), time(12, 30), time(16, 0), time(20, 0)]
+MONDAY = date(2015, 3, 2)
+
+
+def punches(*times):
+    return [Punch(datetime.combine(MONDAY, t)) for t in times]
+
+def monday_record(*times):
+    grid = [g for g in perfect_grid(2015, 3) if g[0] == MONDAY]
+    return list(fixed_records(punches(*times), 2015, 3, grid))[0]
+
+
+def test_late_arrival_keeps_input_slot():
+    times = [time(10, 45), time(12, 30), time(16, 0), time(20, 0)]
+    assert match_punches(SLOTS, times) == times
+
+    morning = monday_record(*times).intervals[0]
+    assert morning.input == time(10, 45)
+    assert morning.output == time(12, 30)
+    assert morning.late == timedelta(hours=2, minutes=15)
+
+
+def test_early_exit_keeps_output_slot():
+    times = [time(8, 30), time(9, 15)]
+    assert match_punches(SLOTS, times) == [time(8, 30), time(9, 15),
+                                           None, None]
+
+    morning, afternoon = monday_record(*times).intervals
+    assert morning.output == time(9, 15)
+    assert afternoon.input is None and afternoon.output is None
+
+
+def test_extra_punches_are_discarded():
+    times = [time(8, 29), time(8, 31), time(12, 30), time(16, 0),
+             time(20, 0), time(20, 5)]
+    assert match_punches(SLOTS, times) == [time(8, 29), time(12, 30),
+                                           time(16, 0), time(20, 0)]
+
+
+def test_duplicate_punches_fill_one_slot():
+    times = [time(8, 29), time(8, 31), time(12, 30)]
+    assert match_punches(SLOTS, times) == [time(8, 29), time(12, 30),
+                                           None, None]
+
+
+def test_near_duplicate_punches_fill_one_slot():
+    times = [time(8, 29), time(8, 30), time(8, 31), time(8, 32)]
+    assert match_punches(SLOTS, times) == [time(8, 29), None, None, None]
+
+    morning = monday_record(*times).intervals[0]
+    assert morning.input == time(8, 29)
+    assert morning.output is None
+
+
+def test_analytics_match_agrees():
+    from nbs.utils.analytics import DAY, EPOCH, Slots, match
+
+    base = (MONDAY - EPOCH).days * DAY
+    def secs(t):
+        return base + (t.hour*60 + t.minute)*60
+
+    slot_times = np.array([secs(t) for t in SLOTS], dtype=np.int64)
+    slots = Slots(slot_times, slot_times // DAY,
+                  np.array([True, False, True, False]))
+    times = np.array([secs(time(10, 45)), secs(time(12, 30)),
+                      secs(time(12, 32))], dtype=np.int64)
+    emp, slot, delta = match(np.zeros(3, dtype=np.int64), times, slots)
+    assert slot.tolist() == [0, 1]
+    assert delta.tolist() == [8100, 0]